@@ -0,0 +1,248 @@
+#!/usr/bin/python
+# Per-repository server that keeps git-cl's caches warm between commands
+
+"""Answers git-cl's read-only commands from a long-running process.
+
+"git cl daemon start" forks a process that listens on the Unix socket
+.git/cl-daemon.sock.  Commands such as "git cl status" send their arguments
+there and print what comes back, so the git config snapshot, the Settings
+and the connection to Rietveld outlive a single command.  Whenever the git
+config or the refs change, the caches are dropped before the next command.
+Without a daemon the commands run in-process as before.
+
+The protocol is one JSON object per line in each direction:
+  {"argv": [...]}  ->  {"exit_code": 0, "stdout": "...", "stderr": "..."}
+  {"stop": true}   ->  {"exit_code": 0}
+"""
+
+import errno
+import json
+import os
+import select
+import socket
+import subprocess
+import sys
+
+SOCKET_NAME = 'cl-daemon.sock'
+
+# The daemon exits after this many seconds without a request.
+IDLE_TIMEOUT = 30 * 60
+
+# How long a client waits for the daemon to answer.
+CLIENT_TIMEOUT = 60
+
+
+def GetSocketPath(git_dir=None):
+  """Returns the daemon's socket path for git_dir or the current repository.
+
+  Returns None outside of a git repository.
+  """
+  if git_dir is None:
+    devnull = open(os.devnull, 'w')
+    try:
+      proc = subprocess.Popen(['git', 'rev-parse', '--git-dir'],
+                              stdout=subprocess.PIPE, stderr=devnull)
+      git_dir = proc.communicate()[0].strip()
+    finally:
+      devnull.close()
+    if proc.returncode or not git_dir:
+      return None
+  return os.path.join(os.path.abspath(git_dir), SOCKET_NAME)
+
+
+def _Connect(path):
+  """Returns a socket connected to the daemon at path, or None.
+
+  A socket file left behind by a daemon that died is removed.
+  """
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(path)
+  except socket.error as e:
+    sock.close()
+    if e.errno == errno.ECONNREFUSED:
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+    return None
+  sock.settimeout(CLIENT_TIMEOUT)
+  return sock
+
+
+def _ReadMessage(sock):
+  """Reads one newline-terminated JSON message, or returns None at EOF."""
+  chunks = []
+  while True:
+    chunk = sock.recv(65536)
+    if not chunk:
+      break
+    chunks.append(chunk)
+    if chunk.endswith('\n'):
+      break
+  data = ''.join(chunks)
+  if not data.endswith('\n'):
+    return None
+  return json.loads(data)
+
+
+def _SendMessage(sock, message):
+  sock.sendall(json.dumps(message) + '\n')
+
+
+def _Call(path, message):
+  """Sends message to the daemon at path and returns its reply, or None."""
+  sock = _Connect(path)
+  if sock is None:
+    return None
+  try:
+    try:
+      _SendMessage(sock, message)
+      return _ReadMessage(sock)
+    except (socket.error, ValueError):
+      return None
+  finally:
+    sock.close()
+
+
+def Request(argv, git_dir=None):
+  """Runs the git-cl command argv in the daemon serving this repository.
+
+  Returns:
+    The reply dict with 'exit_code', 'stdout' and 'stderr', or None if no
+    daemon is running, in which case the command should run in-process.
+  """
+  path = GetSocketPath(git_dir)
+  if path is None or not os.path.exists(path):
+    return None
+  return _Call(path, {'argv': argv})
+
+
+def IsRunning(git_dir):
+  path = GetSocketPath(git_dir)
+  sock = _Connect(path)
+  if sock is None:
+    return False
+  sock.close()
+  return True
+
+
+def Stop(git_dir):
+  """Asks the daemon to exit.  Returns False if none was running."""
+  return _Call(GetSocketPath(git_dir), {'stop': True}) is not None
+
+
+class RepositoryWatcher(object):
+  """Tells whether the git config or the refs changed since the last check.
+
+  Git rewrites these files through a lock file and a rename, so a change
+  shows in the inode and mtime of the file or of its directory.
+  """
+
+  def __init__(self, git_dir):
+    self.git_dir = git_dir
+    self.stamp = None
+
+  def _GetPaths(self):
+    paths = [os.path.expanduser('~/.gitconfig')]
+    for name in ('config', 'HEAD', 'packed-refs'):
+      paths.append(os.path.join(self.git_dir, name))
+    for dirpath, dirnames, filenames in os.walk(
+        os.path.join(self.git_dir, 'refs', 'heads')):
+      paths.append(dirpath)
+      paths.extend(os.path.join(dirpath, name) for name in filenames)
+    return paths
+
+  def _GetStamp(self):
+    stamp = []
+    for path in self._GetPaths():
+      try:
+        st = os.stat(path)
+      except OSError:
+        stamp.append((path, None))
+        continue
+      stamp.append((path, st.st_ino, st.st_mtime, st.st_size))
+    return stamp
+
+  def Changed(self):
+    """Returns True on the first call and whenever something changed."""
+    stamp = self._GetStamp()
+    changed = stamp != self.stamp
+    self.stamp = stamp
+    return changed
+
+
+def Serve(listener, git_dir, handler, idle_timeout=IDLE_TIMEOUT):
+  """Answers requests on listener until stopped or idle for idle_timeout.
+
+  Requests are handled one at a time, since the caches they share are not
+  thread-safe.
+
+  Args:
+    listener: A listening Unix socket.
+    git_dir: The repository's git directory.
+    handler: Called as handler(argv, changed), where changed tells whether
+      the repository changed since the last request, and returns
+      (exit_code, stdout, stderr).
+  """
+  watcher = RepositoryWatcher(git_dir)
+  path = GetSocketPath(git_dir)
+  try:
+    while True:
+      readable = select.select([listener], [], [], idle_timeout)[0]
+      if not readable or not os.path.exists(path):
+        return
+      conn = listener.accept()[0]
+      try:
+        conn.settimeout(CLIENT_TIMEOUT)
+        request = _ReadMessage(conn)
+        if request is None:
+          continue
+        if request.get('stop'):
+          _SendMessage(conn, {'exit_code': 0})
+          return
+        exit_code, stdout, stderr = handler(request['argv'], watcher.Changed())
+        _SendMessage(conn, {'exit_code': exit_code, 'stdout': stdout,
+                            'stderr': stderr})
+      except (socket.error, ValueError, KeyError):
+        pass
+      finally:
+        conn.close()
+  finally:
+    listener.close()
+    try:
+      os.remove(path)
+    except OSError:
+      pass
+
+
+def Start(git_dir, handler):
+  """Starts a daemon for git_dir in the background, see Serve()."""
+  git_dir = os.path.abspath(git_dir)
+  path = GetSocketPath(git_dir)
+  listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  old_umask = os.umask(077)
+  try:
+    listener.bind(path)
+  finally:
+    os.umask(old_umask)
+  listener.listen(5)
+
+  # Double fork, so the daemon is neither our child nor attached to the
+  # terminal.  The socket is already listening, so clients can connect as
+  # soon as this returns.
+  pid = os.fork()
+  if pid:
+    listener.close()
+    os.waitpid(pid, 0)
+    return
+  try:
+    os.setsid()
+    if os.fork():
+      os._exit(0)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+      os.dup2(devnull, fd)
+    Serve(listener, git_dir, handler)
+  finally:
+    os._exit(0)
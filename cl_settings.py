@@ -2,14 +2,85 @@
 # Integrates git-cl with the Allura issue tracking tool
 # Phil Holmes
 
+import getpass
 import os
+import re
 import sys
 import subprocess
-import urllib2
 import textwrap
 
+class ConfigCache:
+  """In-memory snapshot of "git config --list", read once per process.
+
+  Every getter used to start its own "git config <key>" subprocess.  Instead,
+  the whole configuration is read with a single call the first time any key
+  is needed, and writes made through Set/Unset update the snapshot as well.
+  """
+  def __init__(self):
+    self.values = None
+
+  def _Load(self):
+    if self.values is None:
+      self.values = {}
+      output = RunGit(['config', '--list', '-z'], error_ok=True)
+      for entry in output.split('\0'):
+        if not entry:
+          continue
+        # Each entry is "key\nvalue"; keys without a value have no newline.
+        key, _, value = entry.partition('\n')
+        # As with "git config <key>", the last value wins.
+        self.values[key] = value
+    return self.values
+
+  def _CanonicalKey(self, key):
+    """Lowercases the section and variable name, as "git config -l" does.
+
+    The subsection (e.g. the branch name in branch.Foo.merge) keeps its case.
+    """
+    section, dot, rest = key.partition('.')
+    subsection, dot2, name = rest.rpartition('.')
+    if not dot2:
+      return '%s.%s' % (section.lower(), name.lower())
+    return '%s.%s.%s' % (section.lower(), subsection, name.lower())
+
+  def Get(self, key, error_ok=False, error_message=None):
+    """Returns the value of key, or '' if it is unset and error_ok is true."""
+    value = self._Load().get(self._CanonicalKey(key))
+    if value is None:
+      if not error_ok:
+        DieWithError('Command "git config %s" failed.\n' % key +
+                     (error_message or ''))
+      return ''
+    return value.strip()
+
+  def GetRegexp(self, pattern):
+    """Returns a sorted list of (key, value) for keys matching pattern."""
+    regexp = re.compile(pattern)
+    return sorted((key, value.strip())
+                  for key, value in self._Load().iteritems()
+                  if regexp.search(key))
+
+  def Set(self, key, value):
+    RunGit(['config', key, value])
+    if self.values is not None:
+      self.values[self._CanonicalKey(key)] = value
+
+  def Unset(self, key, error_ok=False):
+    RunGit(['config', '--unset-all', key], error_ok=error_ok)
+    if self.values is not None:
+      self.values.pop(self._CanonicalKey(key), None)
+
+  def Invalidate(self):
+    """Forgets the snapshot; the next read starts a fresh "git config"."""
+    self.values = None
+
+
 class Settings:
   def __init__(self):
+    self.Invalidate()
+
+  def Invalidate(self):
+    """Forgets all settings read so far."""
     self.server = None
     self.tracker_server = None
     self.token = None
@@ -67,8 +138,7 @@ class Settings:
     """Return true if this repo looks like it's using git-svn."""
     if self.is_git_svn is None:
       # If you have any "svn-remote.*" config keys, we think you're using svn.
-      self.is_git_svn = RunGit(['config', '--get-regexp', r'^svn-remote\.'],
-                               exit_code=True) == 0
+      self.is_git_svn = bool(config.GetRegexp(r'^svn-remote\.'))
     return self.is_git_svn
 
   def GetSVNBranch(self):
@@ -132,7 +202,7 @@ class Settings:
     return self.viewvc_url
 
   def _GetConfig(self, param, **kwargs):
-    return RunGit(['config', param], **kwargs).strip()
+    return config.Get(param, **kwargs)
 
 class Changelist:
   def __init__(self, branchref=None):
@@ -147,9 +217,11 @@ class Changelist:
     self.has_RietveldIssue = False
     self.has_TrackerIssue = False
     self.has_description = False
+    self.has_patchset = False
     self.RietveldIssue = None
     self.TrackerIssue = None
     self.description = None
+    self.patchset = None
 
   def GetBranch(self):
     """Returns the short branch name, e.g. 'master'."""
@@ -166,10 +238,9 @@ class Changelist:
   def GetUpstreamBranch(self):
     if self.upstream_branch is None:
       branch = self.GetBranch()
-      upstream_branch = RunGit(['config', 'branch.%s.merge' % branch],
-                               error_ok=True).strip()
+      upstream_branch = config.Get('branch.%s.merge' % branch, error_ok=True)
       if upstream_branch:
-        remote = RunGit(['config', 'branch.%s.remote' % branch]).strip()
+        remote = config.Get('branch.%s.remote' % branch)
         # We have remote=origin and branch=refs/heads/foobar; convert to
         # refs/remotes/origin/foobar.
         self.upstream_branch = upstream_branch.replace('heads',
@@ -189,11 +260,30 @@ or verify this branch is set up to track another (via the --track argument to
 
     return self.upstream_branch
 
+  def GetAheadBehind(self, upstream_branch=None):
+    """Returns how many commits this branch and its upstream have apart.
+
+    Args:
+      upstream_branch: The branch to compare with, GetUpstreamBranch() by
+        default.
+
+    Returns:
+      A tuple (ahead, behind): the number of commits of this branch that
+      aren't in upstream_branch, and the number of commits of
+      upstream_branch that aren't in this branch.
+    """
+    if upstream_branch is None:
+      upstream_branch = self.GetUpstreamBranch()
+    output = RunGit(['rev-list', '--left-right', '--count',
+                     '%s...%s' % (self.GetBranchRef(), upstream_branch)])
+    ahead, behind = output.split()
+    return int(ahead), int(behind)
+
   def GetTrackerIssue(self):
     """Returns the Tracker issue associated with this branch."""
     if not self.has_TrackerIssue:
       CheckForMigration()
-      issue = RunGit(['config', self._TrackerIssueSetting()], error_ok=True).strip()
+      issue = config.Get(self._TrackerIssueSetting(), error_ok=True)
       if issue:
         self.TrackerIssue = issue
       else:
@@ -204,7 +294,7 @@ or verify this branch is set up to track another (via the --track argument to
   def GetRietveldIssue(self):
     if not self.has_RietveldIssue:
       CheckForMigration()
-      issue = RunGit(['config', self._RietveldIssueSetting()], error_ok=True).strip()
+      issue = config.Get(self._RietveldIssueSetting(), error_ok=True)
       if issue:
         self.RietveldIssue = issue
       else:
@@ -220,7 +310,11 @@ or verify this branch is set up to track another (via the --track argument to
 
   def GetDescription(self, pretty=False):
     if not self.has_description:
-      if self.GetRietveldIssue():
+      if self.GetRietveldIssue() and rpc_server:
+        self.description = rpc_server.Send(
+            '/%s/description' % self.GetRietveldIssue()).strip()
+      elif self.GetRietveldIssue():
+        import urllib2
         url = self.GetRietveldURL() + '/description'
         self.description = urllib2.urlopen(url).read().strip()
       self.has_description = True
@@ -232,8 +326,7 @@ or verify this branch is set up to track another (via the --track argument to
 
   def GetPatchset(self):
     if not self.has_patchset:
-      patchset = RunGit(['config', self._PatchsetSetting()],
-                        error_ok=True).strip()
+      patchset = config.Get(self._PatchsetSetting(), error_ok=True)
       if patchset:
         self.patchset = patchset
       else:
@@ -244,25 +337,25 @@ or verify this branch is set up to track another (via the --track argument to
   def SetPatchset(self, patchset):
     """Set this branch's patchset.  If patchset=0, clears the patchset."""
     if patchset:
-      RunGit(['config', self._PatchsetSetting(), str(patchset)])
+      config.Set(self._PatchsetSetting(), str(patchset))
     else:
-      RunGit(['config', '--unset', self._PatchsetSetting()])
+      config.Unset(self._PatchsetSetting())
     self.has_patchset = False
 
   def SetTrackerIssue(self, issue):
     """Set this branch's Tracker issue.  If issue=0, clears the issue."""
     if issue:
-      RunGit(['config', self._TrackerIssueSetting(), str(issue)])
+      config.Set(self._TrackerIssueSetting(), str(issue))
     elif self.GetTrackerIssue():
-      RunGit(['config', '--unset', self._TrackerIssueSetting()])
+      config.Unset(self._TrackerIssueSetting())
     self.has_TrackerIssue = False
 
   def SetRietveldIssue(self, issue):
     """Set this branch's Rietveld issue.  If issue=0, clears the issue."""
     if issue:
-      RunGit(['config', self._RietveldIssueSetting(), str(issue)])
+      config.Set(self._RietveldIssueSetting(), str(issue))
     else:
-      RunGit(['config', '--unset', self._RietveldIssueSetting()])
+      config.Unset(self._RietveldIssueSetting())
       self.SetTrackerIssue(0)
       self.SetPatchset(0)
     self.has_RietveldIssue = False
@@ -274,6 +367,7 @@ or verify this branch is set up to track another (via the --track argument to
       password = getpass.getpass('Password for %s: ' % email)
       return email, password
 
+    import upload
     rpc_server = upload.HttpRpcServer(settings.GetServer(),
                                       GetUserCredentials,
                                       host_override=settings.GetServer(),
@@ -318,6 +412,14 @@ def RunGit(args, **kwargs):
   cmd = ['git'] + args
   return RunCommand(cmd, **kwargs)
 
+git_dir = None
+def GetGitDir():
+  """Returns the path of the repository's .git directory."""
+  global git_dir
+  if git_dir is None:
+    git_dir = RunGit(['rev-parse', '--git-dir']).strip()
+  return git_dir
+
 did_migrate_check = False
 def CheckForMigration():
   """Migrate from the old issue format, if found.
@@ -332,19 +434,92 @@ def CheckForMigration():
   if did_migrate_check:
     return
 
-  gitdir = RunGit(['rev-parse', '--git-dir']).strip()
-  storepath = os.path.join(gitdir, 'cl-mapping')
+  storepath = os.path.join(GetGitDir(), 'cl-mapping')
   if os.path.exists(storepath):
     print "old-style git-cl mapping file (%s) found; migrating." % storepath
     store = open(storepath, 'r')
     for line in store:
       branch, issue = line.strip().split()
-      RunGit(['config', 'branch.%s.rietveldissue' % ShortBranchName(branch),
-              issue])
+      config.Set('branch.%s.rietveldissue' % ShortBranchName(branch), issue)
     store.close()
     os.remove(storepath)
   did_migrate_check = True
 
+def GetBranchesInfo():
+  """Returns the review settings of every local branch.
+
+  The settings for all branches come from the config snapshot, so this costs
+  one "for-each-ref" no matter how many branches there are, instead of a
+  "git config" call per branch and setting.  That call also tells how far
+  each branch is from the upstream git knows for it (%(upstream:track)).
+
+  Returns:
+    A list of dicts with keys 'branch', 'rietveld_issue', 'tracker_issue',
+    'patchset', 'upstream', 'ahead' and 'behind', sorted by branch name.
+    Missing settings are None, and so are the counts of branches without an
+    upstream.
+  """
+  CheckForMigration()
+  values = dict(config.GetRegexp(
+      r'^branch\..*\.(rietveldissue|trackerissue|rietveldpatchset)$'))
+  branches = RunGit(['for-each-ref',
+                     '--format=%(refname)%00%(upstream)%00%(upstream:track)',
+                     'refs/heads'])
+  info = []
+  for line in sorted(branches.splitlines()):
+    branchref, upstream, track = line.split('\0')
+    branch = ShortBranchName(branchref)
+    ahead = behind = None
+    if upstream and track != '[gone]':
+      # track is empty when in sync, else like "[ahead 1, behind 2]".
+      counts = dict(re.findall(r'(ahead|behind) (\d+)', track))
+      ahead = int(counts.get('ahead', 0))
+      behind = int(counts.get('behind', 0))
+    info.append({
+        'branch': branch,
+        'rietveld_issue': values.get('branch.%s.rietveldissue' % branch) or None,
+        'tracker_issue': values.get('branch.%s.trackerissue' % branch) or None,
+        'patchset': values.get('branch.%s.rietveldpatchset' % branch) or None,
+        'upstream': upstream or None,
+        'ahead': ahead,
+        'behind': behind,
+    })
+  return info
+
+def ResetCaches():
+  """Forgets everything read from the repository so far.
+
+  Used by cl_daemon, which outlives changes to the config and the refs.
+  """
+  global git_dir, did_migrate_check
+  config.Invalidate()
+  settings.Invalidate()
+  git_dir = None
+  did_migrate_check = False
+
+def GetRpcServer(server=None):
+  """Returns an upload.HttpRpcServer for reading from a review server.
+
+  It sends the cookies saved by upload.py but never asks for a password, so
+  it sees what the user would see in a browser.  The one for the configured
+  server is kept in rpc_server and reused.
+
+  Args:
+    server: The server to talk to, settings.GetServer() by default.
+  """
+  global rpc_server
+  import upload
+  if server is None:
+    host = 'https://' + settings.GetServer()
+    if not rpc_server or rpc_server.host != host:
+      if rpc_server:
+        rpc_server.connection_pool.CloseAll()
+      rpc_server = upload.HttpRpcServer(host, None, save_cookies=True)
+    return rpc_server
+  if '://' not in server:
+    server = 'https://' + server
+  return upload.HttpRpcServer(server, None, save_cookies=True)
+
 def ShortBranchName(branch):
   """Convert a name like 'refs/heads/foo' to just 'foo'."""
   return branch.replace('refs/heads/', '')
@@ -360,5 +535,11 @@ def DieWithError(message):
   print >>sys.stderr, message
   sys.exit(1)
 
+config = ConfigCache()
 settings=Settings()
 
+# The upload.HttpRpcServer for settings.GetServer(), see GetRpcServer().  The
+# daemon sets it up so that its connection to Rietveld is kept across
+# commands; until then, descriptions are fetched with urllib2.
+rpc_server = None
+
@@ -0,0 +1,59 @@
+#!/bin/bash
+
+# Checks that "git cl daemon" answers the read-only commands like the
+# in-process code does, and notices changes to the config.
+
+set -e
+
+. ./test-lib.sh
+
+rm -rf daemon
+git init -q daemon
+(
+  set -e
+  cd daemon
+  echo "test" > test
+  git add test; git commit -q -m "initial commit"
+  git checkout -q -b work
+  git config branch.work.merge refs/heads/master
+  git config branch.work.remote .
+  git config rietveld.server localhost:8080
+
+  test_expect_failure "no daemon is running yet" \
+    "$GIT_CL daemon status"
+
+  $GIT_CL upstream > upstream-in-process
+  $GIT_CL daemon start
+  trap "$GIT_CL daemon stop" EXIT
+
+  test_expect_success "the daemon is running" \
+    "$GIT_CL daemon status"
+  test_expect_success "the daemon prints the upstream branch" \
+    "$GIT_CL upstream | cmp -s - upstream-in-process"
+
+  git config branch.work.rietveldissue 123
+  test_expect_success "the daemon notices config changes" \
+    "$GIT_CL status --field=id | grep -q 123"
+
+  $GIT_CL issue 456 >/dev/null
+  test_expect_success "issues set through the daemon are stored" \
+    "git config branch.work.rietveldissue | grep -q 456"
+
+  git checkout -q -b other
+  test_expect_failure "the daemon notices branch switches" \
+    "$GIT_CL upstream"
+  test_expect_success "the daemon passes on error messages" \
+    "$GIT_CL upstream 2>&1 | grep -q 'Unable to determine'"
+
+  $GIT_CL daemon stop
+  trap - EXIT
+  test_expect_success "the socket is gone after stopping" \
+    "test ! -e .git/cl-daemon.sock"
+)
+SUCCESS=$?
+
+rm -rf daemon
+
+if [ $SUCCESS == 0 ]; then
+  echo PASS
+fi
@@ -37,6 +37,16 @@ setup_gitsvn
 
   # Verify git cl upload fails.
   test_expect_failure "git-cl dcommit hook fails" "$GIT_CL dcommit master"
+
+  # Make the pre-cl-upload hook pass.
+  echo "#!/bin/bash" > .git/hooks/pre-cl-upload
+  echo "echo 'sample preupload pass'" >> .git/hooks/pre-cl-upload
+  chmod 755 .git/hooks/pre-cl-upload
+
+  test_expect_success "git-cl presubmit runs both hooks" \
+    "$GIT_CL presubmit master | grep -q '\[DCOMMIT\] sample predcommit fail'"
+  test_expect_success "git-cl upload doesn't rerun a hook that passed" \
+    "$GIT_CL upload master 2>&1 | grep -q 'pre-cl-upload: passed before'"
 )
 SUCCESS=$?
 
@@ -0,0 +1,67 @@
+#!/bin/bash
+
+# Measures how long git-cl takes to start for the commands that are run
+# from shell prompts and editors, and what importing each of its modules
+# costs.  It needs neither svn nor a Rietveld server.
+#
+# Usage: ./startup-time.sh [runs]
+# Set PYTHON to pick the interpreter (default: python).
+
+set -e
+
+. ./test-lib.sh
+
+RUNS=${1:-10}
+PYTHON=${PYTHON:-python}
+TOP=$PWD/..
+
+# Prints the average wall time of running "$@" $RUNS times, in ms.
+average_ms() {
+  $PYTHON - "$RUNS" "$@" <<'EOF'
+import os, subprocess, sys, time
+runs = int(sys.argv[1])
+devnull = open(os.devnull, 'w')
+start = time.time()
+for _ in range(runs):
+  subprocess.call(sys.argv[2:], stdout=devnull, stderr=devnull)
+print '%6.1f' % ((time.time() - start) * 1000 / runs)
+EOF
+}
+
+rm -rf startup
+git init -q startup
+(
+  set -e
+  cd startup
+  echo "test" > test
+  git add test; git commit -q -m "initial commit"
+  git checkout -q -b work
+  git config branch.work.merge refs/heads/master
+  git config branch.work.remote .
+
+  echo "Import cost (ms):"
+  for module in cl_settings upload urllib2 projecthosting_upload; do
+    printf '  %-22s%s\n' $module \
+      "$(average_ms $PYTHON -c "import sys; sys.path.insert(0, '$TOP'); \
+import $module")"
+  done
+  printf '  %-22s%s\n' "(interpreter)" "$(average_ms $PYTHON -c pass)"
+
+  echo "Command time (ms):"
+  for command in status issue upstream; do
+    printf '  %-22s%s\n' "git cl $command" \
+      "$(average_ms $PYTHON $GIT_CL $command)"
+  done
+
+  test_expect_success "git cl status doesn't import upload" \
+    "! $PYTHON -v $GIT_CL status 2>&1 | grep -q '^import upload '"
+  test_expect_success "git cl status doesn't import gdata" \
+    "! $PYTHON -v $GIT_CL status 2>&1 | grep -q '^import gdata'"
+)
+SUCCESS=$?
+
+rm -rf startup
+
+if [ $SUCCESS == 0 ]; then
+  echo PASS
+fi
@@ -40,21 +40,32 @@ import cookielib
 import errno
 import fnmatch
 import getpass
+import httplib
+import itertools
 import logging
 import marshal
 import mimetypes
+import mmap
 import optparse
 import os
+import random
 import re
+import shutil
 import socket
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import urllib
 import urllib2
 import urlparse
 import webbrowser
+import zlib
 
+from cStringIO import StringIO
 from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree
 
 # The md5 module was deprecated in Python 2.5.
 try:
@@ -92,6 +103,33 @@ DEFAULT_REVIEW_SERVER = "codereview.appspot.com"
 # Max size of patch or base file.
 MAX_UPLOAD_SIZE = 900 * 1024
 
+# Number of idle keep-alive connections kept per host by HttpRpcServer.
+DEFAULT_CONNECTION_POOL_SIZE = 8
+
+# Number of times AbstractRpcServer.Send retries a request that failed with a
+# server or network error, and the bounds of the (jittered, exponential)
+# delay between attempts.
+SEND_MAX_RETRIES = 3
+SEND_RETRY_DELAY = 0.5
+SEND_MAX_RETRY_DELAY = 30
+# Seconds a pooled connection waits on a stalled server before the request
+# fails and can be retried, when the request doesn't set its own timeout.
+SEND_TIMEOUT = 60
+
+# File recording which base files have already been uploaded, see UploadCache.
+UPLOAD_CACHE_FILE = "~/.codereview_upload_cache"
+# The upload cache is compacted to this many entries when it grows past twice
+# that size.
+UPLOAD_CACHE_MAX_ENTRIES = 100000
+
+# File in the .git or .hg directory caching the repository GUID, see GetGUID.
+GUID_CACHE_FILE = "codereview-guid"
+
+# Directory in the .git directory where --git_single_diff keeps the diffs of
+# commit ranges, and how many of them it keeps.
+GIT_DIFF_CACHE_DIR = "codereview-diff-cache"
+GIT_DIFF_CACHE_MAX_ENTRIES = 20
+
 
 # Constants for version control names.  Used by GuessVCSName.
 VCS_GIT = "Git"
@@ -270,6 +308,9 @@ class AbstractRpcServer(object):
     self.extra_headers = extra_headers or {}
     self.save_cookies = save_cookies
     self.account_type = account_type
+    # Number of requests Send() had to retry, see UploadScheduler.
+    self.retries = 0
+    self.retries_lock = threading.Lock()
     self.opener = self._GetOpener()
     if self.host_override:
       LOGGER.info("Server: %s; Host: %s", self.host, self.host_override)
@@ -420,6 +461,17 @@ class AbstractRpcServer(object):
       self._GetAuthCookie(auth_token)
       return
 
+  def _WaitBeforeRetry(self, tries):
+    """Sleeps before retrying a failed request for the tries-th time.
+
+    The delay doubles with every attempt, and is randomized so that
+    concurrent uploads hitting the same problem don't all retry at once.
+    """
+    with self.retries_lock:
+      self.retries += 1
+    delay = min(SEND_MAX_RETRY_DELAY, SEND_RETRY_DELAY * 2 ** (tries - 1))
+    time.sleep(random.uniform(delay / 2, delay))
+
   def Send(self, request_path, payload=None,
            content_type="application/octet-stream",
            timeout=None,
@@ -452,6 +504,9 @@ class AbstractRpcServer(object):
       tries = 0
       while True:
         tries += 1
+        if hasattr(payload, "seek"):
+          # Streamed payloads have to be rewound before they are sent again.
+          payload.seek(0)
         args = dict(kwargs)
         url = "%s%s" % (self.host, request_path)
         if args:
@@ -467,7 +522,7 @@ class AbstractRpcServer(object):
           f.close()
           return response
         except urllib2.HTTPError as e:
-          if tries > 3:
+          if tries > SEND_MAX_RETRIES:
             raise
           elif e.code == 401 or e.code == 302:
             if not self.auth_function:
@@ -482,15 +537,162 @@ class AbstractRpcServer(object):
             # TODO: We should error out on a 500, but the server is too flaky
             # for that at the moment.
             StatusUpdate('Upload got a 500 response: %d' % e.code)
+            self._WaitBeforeRetry(tries)
           else:
             raise
+        except (urllib2.URLError, socket.error, httplib.HTTPException) as e:
+          if tries > SEND_MAX_RETRIES:
+            raise
+          StatusUpdate('Upload got a network error: %s' %
+                       getattr(e, "reason", e))
+          self._WaitBeforeRetry(tries)
     finally:
       socket.setdefaulttimeout(old_timeout)
 
 
+class HTTPConnectionPool(object):
+  """A thread-safe pool of idle persistent HTTP(S) connections.
+
+  Connections are keyed by connection class and host; at most max_per_host
+  idle connections are kept for each key.
+  """
+
+  def __init__(self, max_per_host):
+    self.max_per_host = max_per_host
+    self.lock = threading.Lock()
+    self.idle = {}
+
+  def Get(self, key):
+    """Returns an idle connection for key, or None if there is none."""
+    with self.lock:
+      connections = self.idle.get(key)
+      if connections:
+        return connections.pop()
+    return None
+
+  def Put(self, key, connection):
+    """Returns a connection to the pool, or closes it if the pool is full."""
+    with self.lock:
+      connections = self.idle.setdefault(key, [])
+      if len(connections) < self.max_per_host:
+        connections.append(connection)
+        return
+    connection.close()
+
+  def CloseAll(self):
+    """Closes all idle connections."""
+    with self.lock:
+      idle, self.idle = self.idle, {}
+    for connections in idle.values():
+      for connection in connections:
+        connection.close()
+
+
+def _OpenPooledConnection(handler, pool, http_class, req, **conn_args):
+  """Sends req on a kept-alive connection from pool.
+
+  This is the pooled equivalent of urllib2.AbstractHTTPHandler.do_open, which
+  opens a new connection (and TLS handshake) for every request and asks the
+  server to close it afterwards.
+
+  Returns:
+    A urllib.addinfourl response with the body already read, so that the
+    connection can go back to the pool straight away.
+  """
+  if getattr(req, "_tunnel_host", None):
+    # HTTPS through a CONNECT proxy; let urllib2 handle the tunnel.
+    return handler.do_open(http_class, req, **conn_args)
+  host = req.get_host()
+  if not host:
+    raise urllib2.URLError("no host given")
+  key = (http_class, host)
+  headers = dict(req.unredirected_hdrs)
+  headers.update((k, v) for k, v in req.headers.items() if k not in headers)
+  headers = dict((name.title(), value) for name, value in headers.items())
+  timeout = req.timeout
+  if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+    timeout = socket.getdefaulttimeout()
+  if timeout is None:
+    timeout = SEND_TIMEOUT
+
+  while True:
+    connection = pool.Get(key)
+    reused = connection is not None
+    if reused:
+      # The connection may have been opened for a request with another
+      # timeout, and reconnects use connection.timeout.
+      connection.timeout = timeout
+      if connection.sock is not None:
+        connection.sock.settimeout(timeout)
+    else:
+      connection = http_class(host, timeout=timeout, **conn_args)
+    if hasattr(req.data, "seek"):
+      req.data.seek(0)
+    try:
+      connection.request(req.get_method(), req.get_selector(), req.data,
+                         headers)
+      response = connection.getresponse()
+      body = response.read()
+    except (socket.error, httplib.HTTPException) as e:
+      connection.close()
+      if reused and not isinstance(e, socket.timeout):
+        # The server has probably dropped the idle connection; try a new one.
+        LOGGER.debug("Retrying on a new connection after: %s", e)
+        continue
+      raise urllib2.URLError(e)
+    if response.will_close:
+      connection.close()
+    else:
+      pool.Put(key, connection)
+    result = urllib.addinfourl(StringIO(body), response.msg,
+                               req.get_full_url())
+    result.code = response.status
+    result.msg = response.reason
+    return result
+
+
+class KeepAliveHTTPHandler(urllib2.HTTPHandler):
+  """An HTTPHandler that reuses connections from an HTTPConnectionPool."""
+
+  def __init__(self, pool):
+    urllib2.HTTPHandler.__init__(self)
+    self.pool = pool
+
+  def http_open(self, req):
+    return _OpenPooledConnection(self, self.pool, httplib.HTTPConnection, req)
+
+
+class KeepAliveHTTPSHandler(urllib2.HTTPSHandler):
+  """An HTTPSHandler that reuses connections from an HTTPConnectionPool."""
+
+  def __init__(self, pool):
+    urllib2.HTTPSHandler.__init__(self)
+    self.pool = pool
+
+  def https_open(self, req):
+    conn_args = {}
+    if getattr(self, "_context", None) is not None:
+      conn_args["context"] = self._context
+    return _OpenPooledConnection(self, self.pool, httplib.HTTPSConnection, req,
+                                 **conn_args)
+
+
 class HttpRpcServer(AbstractRpcServer):
   """Provides a simplified RPC-style interface for HTTP requests."""
 
+  def __init__(self, host, auth_function,
+               connection_pool_size=DEFAULT_CONNECTION_POOL_SIZE, **kwargs):
+    """Creates a new HttpRpcServer.
+
+    Args:
+      connection_pool_size: The number of idle connections to keep open per
+        host, so that concurrent uploads don't pay for a new TCP and TLS
+        handshake on every request.
+      Other arguments are passed to AbstractRpcServer.
+    """
+    self.connection_pool = HTTPConnectionPool(connection_pool_size)
+    super(HttpRpcServer, self).__init__(host, auth_function, **kwargs)
+
   def _Authenticate(self):
     """Save the cookie jar after authentication."""
     if isinstance(self.auth_function, OAuth2Creds):
@@ -513,9 +715,9 @@ class HttpRpcServer(AbstractRpcServer):
     opener = urllib2.OpenerDirector()
     opener.add_handler(urllib2.ProxyHandler())
     opener.add_handler(urllib2.UnknownHandler())
-    opener.add_handler(urllib2.HTTPHandler())
+    opener.add_handler(KeepAliveHTTPHandler(self.connection_pool))
     opener.add_handler(urllib2.HTTPDefaultErrorHandler())
-    opener.add_handler(urllib2.HTTPSHandler())
+    opener.add_handler(KeepAliveHTTPSHandler(self.connection_pool))
     opener.add_handler(urllib2.HTTPErrorProcessor())
     if self.save_cookies:
       self.cookie_file = os.path.expanduser("~/.codereview_upload_cookies")
@@ -617,6 +819,10 @@ group.add_option("--oauth2_port", action="store", type="int",
 group.add_option("--no_oauth2_webbrowser", action="store_false",
                  dest="open_oauth2_local_webbrowser", default=True,
                  help="Don't open a browser window to get an access token.")
+group.add_option("--connection_pool_size", action="store", type="int",
+                 dest="connection_pool_size", default=None, metavar="N",
+                 help=("Number of keep-alive connections to the server to "
+                       "reuse. Defaults to the number of parallel uploads."))
 group.add_option("--account_type", action="store", dest="account_type",
                  metavar="TYPE", default=AUTH_ACCOUNT_TYPE,
                  choices=["GOOGLE", "HOSTED"],
@@ -624,8 +830,9 @@ group.add_option("--account_type", action="store", dest="account_type",
                        "(defaults to '%default', "
                        "valid choices are 'GOOGLE' and 'HOSTED')."))
 group.add_option("-j", "--number-parallel-uploads",
-                 dest="num_upload_threads", default=8,
-                 help="Number of uploads to do in parallel.")
+                 dest="num_upload_threads", type="int", default=8,
+                 help=("Number of uploads to do in parallel. Also used for "
+                       "collecting base files from the VCS."))
 # Issue
 group = parser.add_option_group("Issue options")
 group.add_option("-t", "--title", action="store", dest="title",
@@ -672,6 +879,20 @@ group.add_option("--vcs", action="store", dest="vcs",
                  metavar="VCS", default=None,
                  help=("Explicitly specify version control system (%s)"
                        % ", ".join(VCS_SHORT_NAMES)))
+group.add_option("--journal", action="store", dest="journal",
+                 metavar="FILE", default=None,
+                 help=("Record the parts of the upload acknowledged by the "
+                       "server in FILE, so that an interrupted upload can be "
+                       "continued with --resume."))
+group.add_option("--resume", action="store_true", dest="resume",
+                 default=False,
+                 help=("Continue the upload recorded in the --journal file "
+                       "instead of creating a new patch set, if it was for "
+                       "the same diff."))
+group.add_option("--no_upload_cache", action="store_false",
+                 dest="use_upload_cache", default=True,
+                 help=("Don't use the local record of base files already "
+                       "uploaded to an issue (%s)." % UPLOAD_CACHE_FILE))
 group.add_option("--emulate_svn_auto_props", action="store_true",
                  dest="emulate_svn_auto_props", default=False,
                  help=("Emulate Subversion's auto properties feature."))
@@ -687,6 +908,14 @@ group.add_option("--git_only_search_patch", action="store_false", default=True,
 group.add_option("--git_no_find_copies", action="store_false", default=True,
                  dest="git_find_copies",
                  help=("Prevents git from looking for copies (default off)."))
+group.add_option("--git_single_diff", action="store_true",
+                 dest="git_single_diff", default=False,
+                 help=("Detect renames and copies with a single git diff, "
+                       "and cache the result for commit ranges."))
+group.add_option("--git_spill_diff", action="store_true",
+                 dest="git_spill_diff", default=False,
+                 help=("Keep the diff in a temporary file instead of in "
+                       "memory, for very large changes."))
 # Perforce-specific
 group = parser.add_option_group("Perforce-specific options "
                                 "(overrides P4 environment variables)")
@@ -910,7 +1139,8 @@ class OAuth2Creds(object):
 def GetRpcServer(server, email=None, host_override=None, save_cookies=True,
                  account_type=AUTH_ACCOUNT_TYPE, use_oauth2=False,
                  oauth2_port=DEFAULT_OAUTH2_PORT,
-                 open_oauth2_local_webbrowser=True):
+                 open_oauth2_local_webbrowser=True,
+                 connection_pool_size=DEFAULT_CONNECTION_POOL_SIZE):
   """Returns an instance of an AbstractRpcServer.
 
   Args:
@@ -927,6 +1157,7 @@ def GetRpcServer(server, email=None, host_override=None, save_cookies=True,
       redirect is serving. Defaults to DEFAULT_OAUTH2_PORT.
     open_oauth2_local_webbrowser: Boolean, defaults to True. If True and using
       OAuth, this opens a page in the user's browser to obtain a token.
+    connection_pool_size: Number of keep-alive connections to keep per host.
 
   Returns:
     A new HttpRpcServer, on which RPC calls can be made.
@@ -944,7 +1175,8 @@ def GetRpcServer(server, email=None, host_override=None, save_cookies=True,
         extra_headers={"Cookie":
                        'dev_appserver_login="%s:False"' % email},
         save_cookies=save_cookies,
-        account_type=account_type)
+        account_type=account_type,
+        connection_pool_size=connection_pool_size)
     # Don't try to talk to ClientLogin.
     server.authenticated = True
     return server
@@ -958,46 +1190,105 @@ def GetRpcServer(server, email=None, host_override=None, save_cookies=True,
   return HttpRpcServer(*positional_args,
                        host_override=host_override,
                        save_cookies=save_cookies,
-                       account_type=account_type)
+                       account_type=account_type,
+                       connection_pool_size=connection_pool_size)
 
 
-def EncodeMultipartFormData(fields, files):
-  """Encode form fields for multipart/form-data.
+class MultipartBody(object):
+  """A multipart/form-data request body that is read in chunks.
+
+  The field and file values are kept as given (strings, or anything else
+  supporting len() and slicing, such as an mmap) instead of being joined into
+  one string.  urllib2 sends any payload that has a read() method block by
+  block, and takes the Content-Length header from len().
+  """
+
+  def __init__(self, parts):
+    self.parts = parts
+    self.length = sum(len(part) for part in parts)
+    self.seek(0)
+
+  def __len__(self):
+    return self.length
+
+  def seek(self, offset):
+    """Moves to offset; used to rewind the body when a request is retried."""
+    self.index = 0
+    while (self.index < len(self.parts) and
+           offset >= len(self.parts[self.index])):
+      offset -= len(self.parts[self.index])
+      self.index += 1
+    self.offset = offset
+
+  def read(self, size=-1):
+    """Returns up to size bytes (everything left if size is negative)."""
+    chunks = []
+    while self.index < len(self.parts) and size != 0:
+      part = self.parts[self.index]
+      count = len(part) - self.offset
+      if size > 0:
+        count = min(count, size)
+        size -= count
+      chunks.append(part[self.offset:self.offset + count])
+      self.offset += count
+      if self.offset >= len(part):
+        self.index += 1
+        self.offset = 0
+    return "".join(chunks)
+
+
+def EncodeMultipartFormDataStream(fields, files):
+  """Encode form fields for multipart/form-data without copying the values.
 
   Args:
     fields: A sequence of (name, value) elements for regular form fields.
     files: A sequence of (name, filename, value) elements for data to be
            uploaded as files.
   Returns:
-    (content_type, body) ready for httplib.HTTP instance.
-
-  Source:
-    http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/146306
+    (content_type, body) where body is a MultipartBody that can be passed to
+    AbstractRpcServer.Send as the payload.
   """
   BOUNDARY = '-M-A-G-I-C---B-O-U-N-D-A-R-Y-'
   CRLF = '\r\n'
-  lines = []
+  parts = []
   for (key, value) in fields:
-    lines.append('--' + BOUNDARY)
-    lines.append('Content-Disposition: form-data; name="%s"' % key)
-    lines.append('')
+    parts.append('--' + BOUNDARY + CRLF +
+                 'Content-Disposition: form-data; name="%s"' % key + CRLF +
+                 CRLF)
     if isinstance(value, unicode):
       value = value.encode('utf-8')
-    lines.append(value)
+    parts.append(value)
+    parts.append(CRLF)
   for (key, filename, value) in files:
-    lines.append('--' + BOUNDARY)
-    lines.append('Content-Disposition: form-data; name="%s"; filename="%s"' %
-             (key, filename))
-    lines.append('Content-Type: %s' % GetContentType(filename))
-    lines.append('')
+    parts.append('--' + BOUNDARY + CRLF +
+                 'Content-Disposition: form-data; name="%s"; filename="%s"' %
+                 (key, filename) + CRLF +
+                 'Content-Type: %s' % GetContentType(filename) + CRLF +
+                 CRLF)
     if isinstance(value, unicode):
       value = value.encode('utf-8')
-    lines.append(value)
-  lines.append('--' + BOUNDARY + '--')
-  lines.append('')
-  body = CRLF.join(lines)
+    parts.append(value)
+    parts.append(CRLF)
+  parts.append('--' + BOUNDARY + '--' + CRLF)
   content_type = 'multipart/form-data; boundary=%s' % BOUNDARY
-  return content_type, body
+  return content_type, MultipartBody(parts)
+
+
+def EncodeMultipartFormData(fields, files):
+  """Encode form fields for multipart/form-data.
+
+  Args:
+    fields: A sequence of (name, value) elements for regular form fields.
+    files: A sequence of (name, filename, value) elements for data to be
+           uploaded as files.
+  Returns:
+    (content_type, body) ready for httplib.HTTP instance.
+
+  Source:
+    http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/146306
+  """
+  content_type, body = EncodeMultipartFormDataStream(fields, files)
+  return content_type, body.read()
 
 
 def GetContentType(filename):
@@ -1055,6 +1346,33 @@ def RunShellWithReturnCode(command, print_output=False,
                            universal_newlines, env)
   return out, retcode
 
+def RunShellLines(command, universal_newlines=True, env=os.environ):
+  """Executes a command and yields its output line by line as it is read.
+
+  Exits with an error if the command fails.
+  """
+  LOGGER.info("Running %s", command)
+  env = env.copy()
+  env['LC_MESSAGES'] = 'C'
+  # stderr goes to a file rather than a pipe: nothing reads it while stdout
+  # is streamed, and a command writing more than a pipe buffer of warnings
+  # would block forever.
+  stderr = tempfile.TemporaryFile()
+  try:
+    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr,
+                         shell=use_shell,
+                         universal_newlines=universal_newlines, env=env)
+    for line in p.stdout:
+      yield line
+    p.stdout.close()
+    p.wait()
+    stderr.seek(0)
+    errout = stderr.read()
+  finally:
+    stderr.close()
+  if p.returncode:
+    ErrorExit("Got error status from %s:\n%s" % (command, errout))
+
 def RunShell(command, silent_ok=False, universal_newlines=True,
              print_output=False, env=os.environ):
   data, retcode = RunShellWithReturnCode(command, print_output,
@@ -1066,9 +1384,347 @@ def RunShell(command, silent_ok=False, universal_newlines=True,
   return data
 
 
+class UploadCache(object):
+  """A local record of base file contents that an issue already has.
+
+  The server can only skip a base file if it is told its checksum up front
+  (see base_hashes in RealMain), which normally means reading and hashing
+  every base file first.  This cache remembers two things so that unchanged
+  files can be skipped without reading them at all:
+    - the md5 checksum of VCS objects (e.g. git blobs) that were hashed, and
+    - which (server, issue, checksum) base files were successfully uploaded.
+
+  The data is kept in a text file with one entry per line, appended to as
+  uploads succeed.  When the file grows too long, it is rewritten with the
+  entries that were written last.
+  """
+
+  def __init__(self, filename):
+    self.filename = os.path.expanduser(filename)
+    self.lock = threading.Lock()
+    self.objects = {}
+    self.uploads = set()
+    # Maps ("object", object_id) and ("upload", key) to a sequence number,
+    # larger for entries written more recently.
+    self.order = {}
+    self.sequence = 0
+    self.entries = 0
+    self._Load()
+
+  def _Touch(self, entry):
+    self.sequence += 1
+    self.order[entry] = self.sequence
+
+  def _Load(self):
+    try:
+      cache_file = open(self.filename, "r")
+    except IOError:
+      return
+    try:
+      for line in cache_file:
+        fields = line.split()
+        if len(fields) == 5 and fields[0] == "object":
+          self.objects[fields[1]] = (fields[2], int(fields[3]),
+                                     fields[4] == "1")
+          self._Touch(("object", fields[1]))
+        elif len(fields) == 4 and fields[0] == "upload":
+          self.uploads.add(tuple(fields[1:]))
+          self._Touch(("upload", tuple(fields[1:])))
+        else:
+          continue
+        self.entries += 1
+    finally:
+      cache_file.close()
+    if self.entries > 2 * UPLOAD_CACHE_MAX_ENTRIES:
+      self._Compact()
+
+  def _Compact(self):
+    """Rewrites the cache file, keeping only the most recent entries.
+
+    The entries in memory are pruned the same way.
+    """
+    recent = sorted(self.order, key=self.order.get)[-UPLOAD_CACHE_MAX_ENTRIES:]
+    objects = {}
+    uploads = set()
+    lines = []
+    for kind, key in recent:
+      if kind == "object":
+        checksum, size, is_binary = objects[key] = self.objects[key]
+        lines.append("object %s %s %d %d\n" % (key, checksum, size,
+                                               is_binary))
+      else:
+        uploads.add(key)
+        lines.append("upload %s %s %s\n" % key)
+    self.objects = objects
+    self.uploads = uploads
+    self.order = dict((entry, self.order[entry]) for entry in recent)
+    try:
+      cache_file = open(self.filename, "w")
+      try:
+        cache_file.writelines(lines)
+      finally:
+        cache_file.close()
+    except IOError as e:
+      LOGGER.info("Can't rewrite %s: %s", self.filename, e)
+    self.entries = len(lines)
+
+  def _Append(self, line):
+    try:
+      cache_file = open(self.filename, "a")
+      try:
+        cache_file.write(line)
+      finally:
+        cache_file.close()
+      self.entries += 1
+    except IOError as e:
+      LOGGER.info("Can't write %s: %s", self.filename, e)
+
+  def GetObject(self, object_id):
+    """Returns (checksum, size, is_binary) for a VCS object, or None."""
+    return self.objects.get(object_id)
+
+  def AddObject(self, object_id, checksum, size, is_binary):
+    with self.lock:
+      if self.objects.get(object_id) == (checksum, size, is_binary):
+        return
+      self.objects[object_id] = (checksum, size, is_binary)
+      self._Touch(("object", object_id))
+      self._Append("object %s %s %d %d\n" % (object_id, checksum, size,
+                                             is_binary))
+
+  def HasUpload(self, server, issue, checksum):
+    return (server, str(issue), checksum) in self.uploads
+
+  def AddUpload(self, server, issue, checksum):
+    key = (server, str(issue), checksum)
+    with self.lock:
+      if key in self.uploads:
+        return
+      self.uploads.add(key)
+      self._Touch(("upload", key))
+      self._Append("upload %s %s %s\n" % key)
+
+
+class UploadJournal(object):
+  """A record of the parts of a patchset upload the server has acknowledged.
+
+  Uploading a large patchset takes one request per file patch and per base
+  or current file content, and a single failure aborts the whole upload.
+  The journal lets a later run continue where the failed one stopped:
+    upload <server> <issue> <patchset> <diff checksum>
+    patch <patch key> <filename>
+    part <file id> base|current
+  The header is written once the server has created the patchset, and one
+  line is appended for each patch key and each acknowledged content upload.
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.lock = threading.Lock()
+    self.server = None
+    self.issue = None
+    self.patchset = None
+    self.diff_checksum = None
+    # List of [patch key, filename], as returned by the server.
+    self.patches = []
+    # Set of (file id, "base" or "current").
+    self.parts = set()
+
+  def Load(self):
+    try:
+      journal_file = open(self.filename, "r")
+    except IOError:
+      return
+    try:
+      for line in journal_file:
+        fields = line.rstrip("\n").split(" ", 4)
+        if fields[0] == "upload" and len(fields) == 5:
+          self.server, self.issue, self.patchset, self.diff_checksum = (
+              fields[1:])
+        elif fields[0] == "patch" and len(fields) >= 3:
+          self.patches.append(line.rstrip("\n").split(" ", 2)[1:])
+        elif fields[0] == "part" and len(fields) == 3:
+          self.parts.add((int(fields[1]), fields[2]))
+    finally:
+      journal_file.close()
+
+  def Matches(self, server, issue, diff_checksum):
+    """Returns True if the journal is for the same diff and issue."""
+    if not self.issue:
+      return False
+    if issue and str(issue) != self.issue:
+      return False
+    return (server, diff_checksum) == (self.server, self.diff_checksum)
+
+  def _Append(self, lines, mode="a"):
+    with self.lock:
+      try:
+        journal_file = open(self.filename, mode)
+        try:
+          journal_file.writelines(lines)
+        finally:
+          journal_file.close()
+      except IOError as e:
+        LOGGER.info("Can't write %s: %s", self.filename, e)
+
+  def Start(self, server, issue, patchset, diff_checksum):
+    self.server, self.issue, self.patchset = server, str(issue), patchset
+    self.diff_checksum = diff_checksum
+    self.patches = []
+    self.parts = set()
+    self._Append(["upload %s %s %s %s\n" % (server, issue, patchset,
+                                            diff_checksum)], mode="w")
+
+  def AddPatches(self, patches):
+    self.patches.extend(patches)
+    self._Append(["patch %s %s\n" % tuple(patch) for patch in patches])
+
+  def HasPart(self, file_id, is_base):
+    return (file_id, is_base and "base" or "current") in self.parts
+
+  def AddPart(self, file_id, is_base):
+    part = (file_id, is_base and "base" or "current")
+    self.parts.add(part)
+    self._Append(["part %d %s\n" % part])
+
+  def Remove(self):
+    try:
+      os.remove(self.filename)
+    except OSError:
+      pass
+
+
+class UploadScheduler(object):
+  """Runs upload requests concurrently, adapting to how well the server copes.
+
+  Requests are started largest first, so that a few big uploads don't end up
+  running on their own at the end.  The number of requests in flight starts
+  at max_requests and is adjusted as requests finish: it is halved when the
+  server needed a retry since the last request finished, lowered by one when
+  a request took more than twice as long as is typical so far, and raised by
+  one (up to max_requests) otherwise.
+
+  A request that raises, including through sys.exit(), stops the scheduling
+  of new requests, and the exception is re-raised by Run().
+  """
+
+  def __init__(self, rpc_server, max_requests, size_unit="bytes"):
+    self.rpc_server = rpc_server
+    self.max_requests = max(1, max_requests)
+    # What the sizes given to Add() count, for the statistics, or None if
+    # they only decide the order.
+    self.size_unit = size_unit
+    # List of (size, function, args).
+    self.tasks = []
+
+  def Add(self, size, function, *args):
+    """Adds a request of the given size, made by calling function(*args)."""
+    self.tasks.append((size, function, args))
+
+  def Run(self):
+    """Runs all requests.
+
+    Returns:
+      The return values of the request functions, in the order they were
+      added.
+    """
+    pending = sorted(range(len(self.tasks)), key=lambda i: -self.tasks[i][0])
+    results = [None] * len(self.tasks)
+    condition = threading.Condition()
+    # State shared with the worker threads, guarded by condition.
+    state = {
+        "limit": self.max_requests,
+        "lowest_limit": self.max_requests,
+        "active": 0,
+        "error": None,
+        "typical": None,
+        "retries": self.rpc_server.retries,
+    }
+    timings = []
+
+    def Adapt(elapsed):
+      if self.rpc_server.retries > state["retries"]:
+        state["retries"] = self.rpc_server.retries
+        state["limit"] = max(1, state["limit"] // 2)
+      elif state["typical"] and elapsed > 2 * state["typical"]:
+        state["limit"] = max(1, state["limit"] - 1)
+      else:
+        state["limit"] = min(self.max_requests, state["limit"] + 1)
+      state["lowest_limit"] = min(state["lowest_limit"], state["limit"])
+      if state["typical"] is None:
+        state["typical"] = elapsed
+      else:
+        state["typical"] = 0.8 * state["typical"] + 0.2 * elapsed
+
+    def Worker():
+      while True:
+        with condition:
+          while (pending and state["error"] is None and
+                 state["active"] >= state["limit"]):
+            condition.wait()
+          if not pending or state["error"] is not None:
+            return
+          index = pending.pop(0)
+          state["active"] += 1
+        size, function, args = self.tasks[index]
+        started = time.time()
+        error = None
+        try:
+          results[index] = function(*args)
+        except BaseException:
+          error = sys.exc_info()
+        elapsed = time.time() - started
+        with condition:
+          state["active"] -= 1
+          if error:
+            state["error"] = state["error"] or error
+          else:
+            timings.append((elapsed, size))
+            Adapt(elapsed)
+          condition.notify_all()
+
+    started = time.time()
+    initial_retries = self.rpc_server.retries
+    threads = []
+    for _ in range(min(self.max_requests, len(self.tasks))):
+      thread = threading.Thread(target=Worker)
+      thread.daemon = True
+      thread.start()
+      threads.append(thread)
+    for thread in threads:
+      # Join with a timeout so that Ctrl-C still works.
+      while thread.is_alive():
+        thread.join(1)
+    if state["error"]:
+      raise state["error"][0], state["error"][1], state["error"][2]
+    self._PrintStats(timings, time.time() - started,
+                     self.rpc_server.retries - initial_retries,
+                     state["lowest_limit"])
+    return results
+
+  def _PrintStats(self, timings, total_time, retries, lowest_limit):
+    if not timings:
+      return
+    times = sorted(elapsed for elapsed, _ in timings)
+    def Percentile(percent):
+      return times[min(len(times) - 1, len(times) * percent // 100)]
+    size = ""
+    if self.size_unit:
+      size = ", %d %s" % (sum(size for _, size in timings), self.size_unit)
+    StatusUpdate("%d requests%s in %.1fs; per request: min %.2fs, "
+                 "median %.2fs, 90%% %.2fs, max %.2fs; %d retries; "
+                 "concurrency %d-%d." %
+                 (len(times), size, total_time,
+                  times[0], Percentile(50), Percentile(90), times[-1],
+                  retries, lowest_limit, self.max_requests))
+
+
 class VersionControlSystem(object):
   """Abstract base class providing an interface to the VCS."""
 
+  # Whether GetBaseFile() may be called for several files at once.
+  parallel_base_files = True
+
   def __init__(self, options):
     """Constructor.
 
@@ -1076,6 +1732,35 @@ class VersionControlSystem(object):
       options: Command line options.
     """
     self.options = options
+    # UploadCache set by RealMain, or None.
+    self.upload_cache = None
+    # Map of filename -> md5 checksum of the base file, computed only once.
+    self.base_checksums = {}
+    # Map of filename -> size of base files that GetBaseFile didn't read
+    # because the server already has them; see GetDeferredBaseContent().
+    self.deferred_base = {}
+    # UploadJournal of the patchset being uploaded, or None.
+    self.journal = None
+    # The diff for which patch_segments is known, see GetPatchSegments().
+    self.segmented_diff = None
+    self.patch_segments = None
+
+  def GetBaseChecksum(self, filename, base_content):
+    """Returns the md5 checksum of a file's base content, computing it once."""
+    checksum = self.base_checksums.get(filename)
+    if checksum is None:
+      checksum = md5(base_content).hexdigest()
+      self.base_checksums[filename] = checksum
+    return checksum
+
+  def GetDeferredBaseContent(self, filename):
+    """Reads the base content of a file listed in deferred_base.
+
+    Only needed if the server asks for a base file after all, e.g. because
+    the patchset it was uploaded with has been deleted.
+    """
+    raise NotImplementedError(
+        "abstract method -- subclass %s must override" % self.__class__)
 
   def GetGUID(self):
     """Return string to distinguish the repository from others, for example to
@@ -1083,6 +1768,34 @@ class VersionControlSystem(object):
     raise NotImplementedError(
         "abstract method -- subclass %s must override" % self.__class__)
 
+  def _ReadGUIDCache(self, filename):
+    """Returns the (key, GUID) stored by _WriteGUIDCache(), or None."""
+    try:
+      cache_file = open(filename, "r")
+    except IOError:
+      return None
+    try:
+      fields = cache_file.read().split()
+    finally:
+      cache_file.close()
+    if len(fields) != 2:
+      return None
+    return tuple(fields)
+
+  def _WriteGUIDCache(self, filename, key, guid):
+    """Stores the GUID along with a key telling when it is still valid."""
+    try:
+      cache_file = open(filename, "w")
+      try:
+        cache_file.write("%s %s\n" % (key, guid))
+      finally:
+        cache_file.close()
+    except IOError as e:
+      LOGGER.info("Can't write %s: %s", filename, e)
+
+  def Close(self):
+    """Releases what the upload needed, such as helper processes."""
+
   def PostProcessDiff(self, diff):
     """Return the diff with any special post processing this VCS needs, e.g.
     to include an svn-style "Index:"."""
@@ -1097,6 +1810,31 @@ class VersionControlSystem(object):
     raise NotImplementedError(
         "abstract method -- subclass %s must override" % self.__class__)
 
+  def GenerateProcessedDiff(self, args):
+    """Return the current diff, already passed through PostProcessDiff().
+
+    Args:
+      args: Extra arguments to pass to the diff command.
+    """
+    return self.PostProcessDiff(self.GenerateDiff(args))
+
+  def SetPatchSegments(self, diff, segments):
+    """Records where each file's patch is in diff, see GetPatchSegments()."""
+    self.segmented_diff = diff
+    self.patch_segments = segments
+
+  def GetPatchSegments(self, diff):
+    """Returns where each file's patch is in diff, if it is known.
+
+    Returns:
+      A list of (filename, start, end) tuples, such that diff[start:end] is
+      the patch that SplitPatch() would return for filename, or None if the
+      diff wasn't segmented while it was post-processed.
+    """
+    if diff is self.segmented_diff:
+      return self.patch_segments
+    return None
+
   def GetUnknownFiles(self):
     """Return a list of files unknown to the VCS."""
     raise NotImplementedError(
@@ -1139,14 +1877,65 @@ class VersionControlSystem(object):
       are retrieved based on lines that start with "Index:" or
       "Property changes on:".
     """
+    filenames = []
+    seen = set()
+    segments = self.GetPatchSegments(diff)
+    if segments is not None:
+      names = [filename for filename, _, _ in segments]
+    else:
+      names = []
+      for line in diff.splitlines(True):
+        if (line.startswith('Index:') or
+            line.startswith('Property changes on:')):
+          names.append(line.split(':', 1)[1])
+    for filename in names:
+      # On Windows if a file has property changes its filename uses '\'
+      # instead of '/'.
+      filename = filename.strip().replace('\\', '/')
+      if filename not in seen:
+        seen.add(filename)
+        filenames.append(filename)
+    return self.CollectBaseFiles(filenames)
+
+  def CollectBaseFiles(self, filenames):
+    """Calls GetBaseFile for each of filenames, in parallel if possible.
+
+    Up to --number-parallel-uploads files are fetched at once.  Errors still
+    go through ErrorExit() and abort the upload.
+
+    Returns:
+      A dictionary that maps from filename to GetBaseFile's tuple.
+    """
+    num_threads = min(self.options.num_upload_threads, len(filenames))
+    if num_threads <= 1 or not self.parallel_base_files:
+      return dict((filename, self.GetBaseFile(filename))
+                  for filename in filenames)
+
+    def GetBaseFileOrExit(filename):
+      # ErrorExit() raises SystemExit, which would silently kill the pool's
+      # worker thread; hand it back so it can be re-raised here.
+      try:
+        return self.GetBaseFile(filename), None
+      except SystemExit as e:
+        return None, e
+
+    thread_pool = ThreadPool(num_threads)
+    try:
+      pending = thread_pool.map_async(GetBaseFileOrExit, filenames,
+                                      chunksize=1)
+      # Wait with a timeout so that Ctrl-C still works.
+      while not pending.ready():
+        pending.wait(1)
+      results = pending.get()
+    finally:
+      # Once interrupted, the files that haven't been started are dropped.
+      thread_pool.terminate()
+      thread_pool.join()
     files = {}
-    for line in diff.splitlines(True):
-      if line.startswith('Index:') or line.startswith('Property changes on:'):
-        unused, filename = line.split(':', 1)
-        # On Windows if a file has property changes its filename uses '\'
-        # instead of '/'.
-        filename = filename.strip().replace('\\', '/')
-        files[filename] = self.GetBaseFile(filename)
+    for filename, (result, exit_exception) in zip(filenames, results):
+      if exit_exception is not None:
+        raise exit_exception
+      files[filename] = result
     return files
 
 
@@ -1161,6 +1950,8 @@ class VersionControlSystem(object):
         type = "base"
       else:
         type = "current"
+      if content is None:
+        content = self.GetDeferredBaseContent(filename)
       if len(content) > MAX_UPLOAD_SIZE:
         result = ("Not uploading the %s file for %s because it's too large." %
             (type, filename))
@@ -1168,7 +1959,10 @@ class VersionControlSystem(object):
         content = ""
       elif options.verbose:
         result = "Uploading %s file for %s" % (type, filename)
-      checksum = md5(content).hexdigest()
+      if is_base and not file_too_large:
+        checksum = self.GetBaseChecksum(filename, content)
+      else:
+        checksum = md5(content).hexdigest()
       url = "/%d/upload_content/%d/%d" % (int(issue), int(patchset), file_id)
       form_fields = [("filename", filename),
                      ("status", status),
@@ -1180,8 +1974,8 @@ class VersionControlSystem(object):
         form_fields.append(("file_too_large", "1"))
       if options.email:
         form_fields.append(("user", options.email))
-      ctype, body = EncodeMultipartFormData(form_fields,
-                                            [("data", filename, content)])
+      ctype, body = EncodeMultipartFormDataStream(form_fields,
+                                                  [("data", filename, content)])
       try:
         response_body = rpc_server.Send(url, body, content_type=ctype)
       except urllib2.HTTPError as e:
@@ -1192,32 +1986,65 @@ class VersionControlSystem(object):
         StatusUpdate("  --> %s" % response_body)
         sys.exit(1)
 
+      if is_base and not file_too_large and self.upload_cache:
+        self.upload_cache.AddUpload(options.server, issue, checksum)
+      if self.journal:
+        self.journal.AddPart(file_id, is_base)
       return result
 
     patches = dict()
     [patches.setdefault(v, k) for k, v in patch_list]
 
-    threads = []
-    thread_pool = ThreadPool(options.num_upload_threads)
+    scheduler = UploadScheduler(rpc_server, options.num_upload_threads)
+    skipped_files = 0
+    skipped_bytes = 0
+    resumed_parts = 0
 
     for filename in patches.keys():
       base_content, new_content, is_binary, status = files[filename]
+      has_base = base_content is not None or filename in self.deferred_base
       file_id_str = patches.get(filename)
       if file_id_str.find("nobase") != -1:
-        base_content = None
+        # The server already has this base file from an earlier patchset.
+        if has_base:
+          skipped_files += 1
+          if base_content is not None:
+            skipped_bytes += len(base_content)
+          else:
+            skipped_bytes += self.deferred_base[filename]
+          checksum = self.base_checksums.get(filename)
+          if self.upload_cache and checksum:
+            self.upload_cache.AddUpload(options.server, issue, checksum)
+        has_base = False
         file_id_str = file_id_str[file_id_str.rfind("_") + 1:]
       file_id = int(file_id_str)
-      if base_content != None:
-        t = thread_pool.apply_async(UploadFile, args=(filename,
-            file_id, base_content, is_binary, status, True))
-        threads.append(t)
+      if self.journal:
+        # Parts acknowledged by an earlier, interrupted run.
+        if has_base and self.journal.HasPart(file_id, True):
+          has_base = False
+          resumed_parts += 1
+        if new_content != None and self.journal.HasPart(file_id, False):
+          new_content = None
+          resumed_parts += 1
+      if has_base:
+        if base_content is not None:
+          size = len(base_content)
+        else:
+          size = self.deferred_base[filename]
+        scheduler.Add(size, UploadFile, filename, file_id, base_content,
+                      is_binary, status, True)
       if new_content != None:
-        t = thread_pool.apply_async(UploadFile, args=(filename,
-            file_id, new_content, is_binary, status, False))
-        threads.append(t)
+        scheduler.Add(len(new_content), UploadFile, filename, file_id,
+                      new_content, is_binary, status, False)
 
-    for t in threads:
-      print t.get(timeout=60)
+    for result in scheduler.Run():
+      print result
+    if skipped_files:
+      StatusUpdate("Skipped %d base files already on the server "
+                   "(%d bytes saved)." % (skipped_files, skipped_bytes))
+    if resumed_parts:
+      StatusUpdate("Skipped %d files uploaded by the previous attempt." %
+                   resumed_parts)
 
 
   def IsImage(self, filename):
@@ -1250,6 +2077,14 @@ class SubversionVCS(VersionControlSystem):
     # Cache output from "svn list -r REVNO dirname".
     # Keys: dirname, Values: 2-tuple (ouput for start rev and end rev).
     self.svnls_cache = {}
+    # Output of "svn info" for the current directory.
+    self.svn_info = None
+    # Metadata prefetched for all files of the diff, see _PrefetchMetadata().
+    # Map of filename -> status as printed by "svn status".
+    self.status_table = {}
+    # Map of filename -> dict of properties, in the working copy for added
+    # files and in the BASE revision for the others.
+    self.props_table = {}
     # Base URL is required to fetch files deleted in an older revision.
     # Result is cached to not guess it over and over again in GetBaseFile().
     required = self.options.download_base or self.options.revision is not None
@@ -1292,7 +2127,9 @@ class SubversionVCS(VersionControlSystem):
 
   def _GetInfo(self, key):
     """Parses 'svn info' for current dir. Returns value for key or None"""
-    for line in RunShell(["svn", "info"]).splitlines():
+    if self.svn_info is None:
+      self.svn_info = RunShell(["svn", "info"])
+    for line in self.svn_info.splitlines():
       if line.startswith(key + ": "):
         return line.split(":", 1)[1].strip()
 
@@ -1344,7 +2181,7 @@ class SubversionVCS(VersionControlSystem):
          return "$%s::%s$" % (m.group(1), " " * len(m.group(3)))
        return "$%s$" % m.group(1)
     keywords = [keyword
-                for name in keyword_str.split(" ")
+                for name in keyword_str.split()
                 for keyword in svn_keywords.get(name, [])]
     return re.sub(r"\$(%s):(:?)([^\$]+)\$" % '|'.join(keywords), repl, content)
 
@@ -1366,8 +2203,98 @@ class SubversionVCS(VersionControlSystem):
       file.close()
     return result
 
+  def CollectBaseFiles(self, filenames):
+    if not self.options.revision:
+      self._PrefetchMetadata(filenames)
+    return super(SubversionVCS, self).CollectBaseFiles(filenames)
+
+  def _RunXmlCommand(self, args, filenames):
+    """Runs an svn command with --xml for all filenames at once.
+
+    Returns:
+      The root element of the output, or None if the command failed.
+    """
+    targets = tempfile.NamedTemporaryFile(delete=False)
+    try:
+      targets.write("".join(self._EscapeFilename(filename) + "\n"
+                            for filename in filenames))
+      targets.close()
+      cmd = ["svn"] + args + ["--xml", "--targets", targets.name]
+      output, errout, returncode = RunShellWithReturnCodeAndStderr(cmd)
+    finally:
+      os.remove(targets.name)
+    if returncode:
+      LOGGER.info("%s failed, falling back to one call per file: %s",
+                  cmd, errout)
+      return None
+    try:
+      return ElementTree.fromstring(output)
+    except SyntaxError as e:
+      LOGGER.info("Can't parse the output of %s: %s", cmd, e)
+      return None
+
+  def _PrefetchMetadata(self, filenames):
+    """Gets the status and properties of all files with one "svn status" and
+    at most two "svn proplist" calls, instead of several calls per file.
+
+    GetStatus() and GetBaseFile() use the results, and fall back to running
+    svn for a single file when something isn't in the tables.
+    """
+    # Characters of the first columns of "svn status" for the attributes of
+    # the "wc-status" element in its XML output.
+    ITEM_STATUS = {
+        "added": "A", "conflicted": "C", "deleted": "D", "external": "X",
+        "ignored": "I", "incomplete": "!", "missing": "!", "modified": "M",
+        "obstructed": "~", "replaced": "R", "unversioned": "?",
+    }
+    PROPS_STATUS = {"conflicted": "C", "modified": "M"}
+
+    if not filenames:
+      return
+    root = self._RunXmlCommand(["status", "--ignore-externals"], filenames)
+    if root is None:
+      return
+    for entry in root.findall(".//entry"):
+      wc_status = entry.find("wc-status")
+      if wc_status is None:
+        continue
+      status = (ITEM_STATUS.get(wc_status.get("item"), " ") +
+                PROPS_STATUS.get(wc_status.get("props"), " ") +
+                (wc_status.get("wc-locked") == "true" and "L" or " ") +
+                (wc_status.get("copied") == "true" and "+" or " ") +
+                (wc_status.get("switched") == "true" and "S" or " ") +
+                "  ")
+      self.status_table[entry.get("path").replace(os.sep, "/")] = status
+
+    # Added files have no BASE revision to get the properties from.
+    added = []
+    existing = []
+    for filename in filenames:
+      status = self.status_table.get(filename)
+      if not status:
+        continue
+      if status[0] == "A" and status[3] != "+":
+        added.append(filename)
+      else:
+        existing.append(filename)
+    for args, batch in ((["proplist", "-v"], added),
+                        (["proplist", "-v", "-r", "BASE"], existing)):
+      if not batch:
+        continue
+      root = self._RunXmlCommand(args, batch)
+      if root is None:
+        continue
+      props = dict((filename, {}) for filename in batch)
+      for target in root.findall("target"):
+        props[target.get("path").replace(os.sep, "/")] = dict(
+            (prop.get("name"), prop.text or "")
+            for prop in target.findall("property"))
+      self.props_table.update(props)
+
   def GetStatus(self, filename):
     """Returns the status of a file."""
+    if filename in self.status_table:
+      return self.status_table[filename]
     if not self.options.revision:
       status = RunShell(["svn", "status", "--ignore-externals",
                          self._EscapeFilename(filename)])
@@ -1430,8 +2357,11 @@ class SubversionVCS(VersionControlSystem):
     if status[0] == "A" and status[3] != "+":
       # We'll need to upload the new content if we're adding a binary file
       # since diff's output won't contain it.
-      mimetype = RunShell(["svn", "propget", "svn:mime-type",
-                           self._EscapeFilename(filename)], silent_ok=True)
+      if filename in self.props_table:
+        mimetype = self.props_table[filename].get("svn:mime-type", "")
+      else:
+        mimetype = RunShell(["svn", "propget", "svn:mime-type",
+                             self._EscapeFilename(filename)], silent_ok=True)
       base_content = ""
       is_binary = bool(mimetype) and not mimetype.startswith("text/")
       if is_binary:
@@ -1447,14 +2377,17 @@ class SubversionVCS(VersionControlSystem):
         # Don't change filename, it's needed later.
         url = filename
         args += ["-r", "BASE"]
-      cmd = ["svn"] + args + ["propget", "svn:mime-type", url]
-      mimetype, returncode = RunShellWithReturnCode(cmd)
-      if returncode:
-        # File does not exist in the requested revision.
-        # Reset mimetype, it contains an error message.
-        mimetype = ""
+      if filename in self.props_table:
+        mimetype = self.props_table[filename].get("svn:mime-type", "").strip()
       else:
-        mimetype = mimetype.strip()
+        cmd = ["svn"] + args + ["propget", "svn:mime-type", url]
+        mimetype, returncode = RunShellWithReturnCode(cmd)
+        if returncode:
+          # File does not exist in the requested revision.
+          # Reset mimetype, it contains an error message.
+          mimetype = ""
+        else:
+          mimetype = mimetype.strip()
       get_base = False
       # this test for binary is exactly the test prescribed by the
       # official SVN docs at
@@ -1503,14 +2436,19 @@ class SubversionVCS(VersionControlSystem):
           elif ret_code:
             ErrorExit("Got error status from 'svn cat %s'" % filename)
         if not is_binary:
-          args = []
-          if self.rev_start:
-            url = "%s/%s@%s" % (self.svn_base, filename, self.rev_start)
+          if filename in self.props_table:
+            keywords = self.props_table[filename].get("svn:keywords")
+            returncode = 0
           else:
-            url = filename
-            args += ["-r", "BASE"]
-          cmd = ["svn"] + args + ["propget", "svn:keywords", url]
-          keywords, returncode = RunShellWithReturnCode(cmd)
+            args = []
+            if self.rev_start:
+              url = "%s/%s@%s" % (self.svn_base, filename, self.rev_start)
+            else:
+              url = filename
+              args += ["-r", "BASE"]
+            cmd = ["svn"] + args + ["propget", "svn:keywords", url]
+            keywords, returncode = RunShellWithReturnCode(cmd)
+            keywords = keywords.strip()
           if keywords and not returncode:
             base_content = self._CollapseKeywords(base_content, keywords)
     else:
@@ -1519,6 +2457,84 @@ class SubversionVCS(VersionControlSystem):
     return base_content, new_content, is_binary, status[0:5]
 
 
+class GitCatFileBatch(object):
+  """Reads git objects through one long-lived "git cat-file --batch" process.
+
+  Starting "git show" once per file dominates the time spent collecting base
+  files for large changes; this streams all of them over a single pipe.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.proc = None
+    self.failed = False
+
+  def Close(self):
+    """Ends the batch process, if one was started."""
+    with self.lock:
+      self._Close()
+
+  def _Stop(self):
+    self.failed = True
+    self._Close()
+
+  def _Close(self):
+    if self.proc:
+      try:
+        self.proc.stdin.close()
+        self.proc.wait()
+        self.proc.stdout.close()
+      except (OSError, IOError):
+        pass
+      self.proc = None
+
+  def Read(self, object_name):
+    """Returns the raw content of object_name (e.g. a blob hash or HEAD:path).
+
+    Returns None if the object doesn't exist or the batch process is not
+    available, in which case the caller should fall back to "git show".
+    """
+    if "\n" in object_name:
+      return None
+    with self.lock:
+      if self.failed:
+        return None
+      try:
+        if self.proc is None:
+          LOGGER.info("Starting git cat-file --batch")
+          self.proc = subprocess.Popen(["git", "cat-file", "--batch"],
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       shell=use_shell)
+        self.proc.stdin.write(object_name + "\n")
+        self.proc.stdin.flush()
+        header = self.proc.stdout.readline()
+        if not header:
+          self._Stop()
+          return None
+        # "<hash> <type> <size>", or "<object> missing" if it doesn't exist.
+        # The object name may contain spaces, so check the end first.
+        header = header.rstrip("\n")
+        if header.endswith(" missing") or header.endswith(" ambiguous"):
+          return None
+        fields = header.split()
+        if len(fields) != 3:
+          self._Stop()
+          return None
+        size = int(fields[2])
+        data = self.proc.stdout.read(size)
+        # Each object is followed by a newline.
+        self.proc.stdout.read(1)
+        if len(data) != size:
+          self._Stop()
+          return None
+        return data
+      except (OSError, IOError, ValueError) as e:
+        LOGGER.info("git cat-file --batch failed: %s", e)
+        self._Stop()
+        return None
+
+
 class GitVCS(VersionControlSystem):
   """Implementation of the VersionControlSystem interface for Git."""
 
@@ -1529,23 +2545,86 @@ class GitVCS(VersionControlSystem):
     self.hashes = {}
     # Map of new filename -> old filename for renames.
     self.renames = {}
+    # Shared reader for blob contents, see GetFileContent().
+    self.cat_file = GitCatFileBatch()
+    # Temporary file holding the diff with --git_spill_diff.
+    self.spill_file = None
+
+  def Close(self):
+    self.cat_file.Close()
 
   def GetGUID(self):
-    revlist = RunShell("git rev-list --parents HEAD".split()).splitlines()
-    # M-A: Return the 1st root hash, there could be multiple when a
-    # subtree is merged. In that case, more analysis would need to
-    # be done to figure out which HEAD is the 'most representative'.
-    for r in revlist:
-      if ' ' not in r:
-        return r
+    """Returns the root commit of HEAD, cached in .git/codereview-guid.
+
+    The cache records HEAD along with its root.  While the commits added
+    since then bring no other root, the cached one is still the answer, and
+    checking that only walks the new commits.
+    """
+    # One per line; the git directory is an absolute path, possibly with
+    # spaces, when run from a subdirectory.
+    git_dir, head = RunShell(["git", "rev-parse", "--git-dir",
+                              "HEAD"]).splitlines()
+    cache_file = os.path.join(git_dir, GUID_CACHE_FILE)
+    cached = self._ReadGUIDCache(cache_file)
+    guid = None
+    if cached:
+      cached_head, cached_guid = cached
+      if cached_head == head:
+        return cached_guid
+      new_roots, retcode = RunShellWithReturnCode(
+          ["git", "rev-list", "--max-parents=0", head, "^" + cached_head])
+      if not retcode and not new_roots.strip():
+        guid = cached_guid
+    if guid is None:
+      # M-A: Return the 1st root hash, there could be multiple when a
+      # subtree is merged. In that case, more analysis would need to
+      # be done to figure out which HEAD is the 'most representative'.
+      roots = RunShell(["git", "rev-list", "--max-parents=0", head]).split()
+      guid = roots[0]
+    self._WriteGUIDCache(cache_file, head, guid)
+    return guid
 
   def PostProcessDiff(self, gitdiff):
     """Converts the diff output to include an svn-style "Index:" line as well
     as record the hashes of the files, so we can upload them along with our
     diff."""
+    svndiff, filecount = self._ProcessDiffLines(
+        line + "\n" for line in gitdiff.splitlines())
+    if not filecount:
+      ErrorExit("No valid patches found in output from git diff")
+    return svndiff
+
+  def _ProcessDiffLines(self, lines, spill_file=None):
+    """Does the work of PostProcessDiff() in one pass over the lines of a
+    git diff, which can be read as they are produced.
+
+    Besides self.hashes and self.renames, this records where each file's
+    patch starts and ends in the result, see GetPatchSegments().
+
+    Args:
+      lines: An iterable over the lines of the git diff.
+      spill_file: If given, a file to write the svn-style diff to instead of
+        building it in memory.  The diff is then returned as a read-only
+        mmap of the file.
+
+    Returns:
+      A tuple (svn-style diff, number of files in it).
+    """
     # Special used by git to indicate "no such content".
     NULL_HASH = "0"*40
 
+    svndiff = []
+    segments = []
+    # Offset of the end of svndiff, and of the current file's patch in it.
+    offset = [0, 0]
+
+    def Append(text):
+      if spill_file:
+        spill_file.write(text)
+      else:
+        svndiff.append(text)
+      offset[0] += len(text)
+
     def IsFileNew(filename):
       return filename in self.hashes and self.hashes[filename][0] is None
 
@@ -1560,24 +2639,35 @@ class GitVCS(VersionControlSystem):
       if self.options.emulate_svn_auto_props and IsFileNew(filename):
         svnprops = GetSubversionPropertyChanges(filename)
         if svnprops:
-          svndiff.append("\n" + svnprops + "\n")
+          Append("\n" + svnprops + "\n")
+
+    def EndFile(filename):
+      # Add auto property for the previously seen file.
+      AddSubversionPropertyChange(filename)
+      segments.append((filename.strip(), offset[1], offset[0]))
 
-    svndiff = []
     filecount = 0
     filename = None
-    for line in gitdiff.splitlines():
-      match = re.match(r"diff --git a/(.*) b/(.*)$", line)
+    for line in lines:
+      if not line.endswith("\n"):
+        line += "\n"
+      # Only header lines can match, so avoid running the regexps on the
+      # lines of the hunks.
+      if line.startswith("diff --git a/"):
+        match = re.match(r"diff --git a/(.*) b/(.*)$", line)
+      else:
+        match = None
       if match:
-        # Add auto property here for previously seen file.
         if filename is not None:
-          AddSubversionPropertyChange(filename)
+          EndFile(filename)
         filecount += 1
+        offset[1] = offset[0]
         # Intentionally use the "after" filename so we can show renames.
         filename = match.group(2)
-        svndiff.append("Index: %s\n" % filename)
+        Append("Index: %s\n" % filename)
         if match.group(1) != match.group(2):
           self.renames[match.group(2)] = match.group(1)
-      else:
+      elif line.startswith("index "):
         # The "index" line in a git diff looks like this (long hashes elided):
         #   index 82c0d44..b2cee3f 100755
         # We want to save the left hash, as that identifies the base file.
@@ -1589,15 +2679,23 @@ class GitVCS(VersionControlSystem):
           if after == NULL_HASH:
             after = None
           self.hashes[filename] = (before, after)
-      svndiff.append(line + "\n")
-    if not filecount:
-      ErrorExit("No valid patches found in output from git diff")
-    # Add auto property for the last seen file.
-    assert filename is not None
-    AddSubversionPropertyChange(filename)
-    return "".join(svndiff)
+      Append(line)
+    if filename is not None:
+      EndFile(filename)
+    if spill_file and offset[0]:
+      spill_file.flush()
+      svndiff = mmap.mmap(spill_file.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+      svndiff = "".join(svndiff)
+    self.SetPatchSegments(svndiff, segments)
+    return svndiff, filecount
 
-  def GenerateDiff(self, extra_args):
+  def _GetDiffOptions(self, extra_args):
+    """Returns the parts of the git diff commands that produce the diff.
+
+    Returns:
+      A tuple (command, similarity options, extra args, environment).
+    """
     extra_args = extra_args[:]
     if self.options.revision:
       if ":" in self.options.revision:
@@ -1611,17 +2709,10 @@ class GitVCS(VersionControlSystem):
     env = os.environ.copy()
     if "GIT_EXTERNAL_DIFF" in env:
       del env["GIT_EXTERNAL_DIFF"]
-    # -M/-C will not print the diff for the deleted file when a file is renamed.
-    # This is confusing because the original file will not be shown on the
-    # review when a file is renamed. So, get a diff with ONLY deletes, then
-    # append a diff (with rename detection), without deletes.
     cmd = [
         "git", "diff", "--no-color", "--no-ext-diff", "--full-index",
         "--ignore-submodules", "--src-prefix=a/", "--dst-prefix=b/",
     ]
-    diff = RunShell(
-        cmd + ["--no-renames", "--diff-filter=D"] + extra_args,
-        env=env, silent_ok=True)
     assert 0 <= self.options.git_similarity <= 100
     if self.options.git_find_copies:
       similarity_options = ["-l100000", "-C%d%%" % self.options.git_similarity]
@@ -1629,15 +2720,357 @@ class GitVCS(VersionControlSystem):
         similarity_options.append("--find-copies-harder")
     else:
       similarity_options = ["-M%d%%" % self.options.git_similarity ]
-    diff += RunShell(
+    return cmd, similarity_options, extra_args, env
+
+  def _GetDiffCommands(self, extra_args):
+    """Returns the git diff commands whose concatenated output is the diff,
+    the environment to run them in and the command line to show in errors."""
+    cmd, similarity_options, extra_args, env = self._GetDiffOptions(extra_args)
+    # -M/-C will not print the diff for the deleted file when a file is renamed.
+    # This is confusing because the original file will not be shown on the
+    # review when a file is renamed. So, get a diff with ONLY deletes, then
+    # append a diff (with rename detection), without deletes.
+    commands = [
+        cmd + ["--no-renames", "--diff-filter=D"] + extra_args,
         cmd + ["--diff-filter=AMCRT"] + similarity_options + extra_args,
-        env=env, silent_ok=True)
+    ]
+    return commands, env, cmd + extra_args
+
+  def GenerateDiff(self, extra_args):
+    diff = None
+    if self.options.git_single_diff:
+      diff = self._GenerateSingleDiff(extra_args)
+    if diff is None:
+      commands, env, cmd = self._GetDiffCommands(extra_args)
+      diff = "".join(RunShell(command, env=env, silent_ok=True)
+                     for command in commands)
+
+      # The CL could be only file deletion or not. So accept silent diff for
+      # both commands then check for an empty diff manually.
+      if not diff:
+        ErrorExit("No output from %s" % cmd)
+    return diff
 
+  def GenerateProcessedDiff(self, extra_args):
+    """Post-processes the git diff output while reading it from the pipe,
+    instead of holding the raw diff in memory first.
+
+    With --git_spill_diff, the result is written to a temporary file and
+    returned as an mmap of it, so that memory use doesn't grow with the size
+    of the diff.
+    """
+    spill_file = None
+    if self.options.git_spill_diff:
+      # Deleted when closed; the mmap of it stays valid until then.
+      spill_file = self.spill_file = tempfile.TemporaryFile()
+    if self.options.git_single_diff:
+      lines = self._GenerateSingleDiffLines(extra_args)
+      if lines is not None:
+        svndiff, filecount = self._ProcessDiffLines(lines, spill_file)
+        if not filecount:
+          ErrorExit("No valid patches found in output from git diff")
+        return svndiff
+    commands, env, cmd = self._GetDiffCommands(extra_args)
+    got_output = [False]
+
+    def Lines():
+      for command in commands:
+        for line in RunShellLines(command, env=env):
+          got_output[0] = True
+          yield line
+
+    svndiff, filecount = self._ProcessDiffLines(Lines(), spill_file)
     # The CL could be only file deletion or not. So accept silent diff for both
     # commands then check for an empty diff manually.
-    if not diff:
-      ErrorExit("No output from %s" % (cmd + extra_args))
-    return diff
+    if not got_output[0]:
+      ErrorExit("No output from %s" % cmd)
+    if not filecount:
+      ErrorExit("No valid patches found in output from git diff")
+    return svndiff
+
+  def _GenerateSingleDiff(self, extra_args):
+    """Returns the diff of _GenerateSingleDiffLines() as a string, or None."""
+    lines = self._GenerateSingleDiffLines(extra_args)
+    if lines is None:
+      return None
+    return "".join(lines)
+
+  def _GenerateSingleDiffLines(self, extra_args):
+    """Generates the same diff as the commands of _GetDiffCommands(), but
+    with a single, rename detecting, git diff.
+
+    The deletions that the first command would have shown for the sources of
+    renames are rebuilt from the blobs.  If the diff is between two commits,
+    it is cached by their trees and the similarity options, so that uploading
+    the same range again doesn't detect renames and copies again.
+
+    The output of git diff goes to temporary files as it is read, so that
+    memory use doesn't grow with the size of the diff.
+
+    Returns:
+      An iterator over the lines of the diff, or None if it has to be
+      generated with two commands, e.g. because the file names need quoting
+      or a diff driver is configured.
+    """
+    cmd, similarity_options, extra_args, env = self._GetDiffOptions(extra_args)
+    trees = self._GetDiffTrees(extra_args)
+    cache_file = None
+    if trees:
+      key = " ".join(list(trees) + cmd + similarity_options)
+      cache_dir = os.path.join(
+          RunShell(["git", "rev-parse", "--git-dir"]).strip(),
+          GIT_DIFF_CACHE_DIR)
+      cache_file = os.path.join(cache_dir, md5(key).hexdigest())
+      diff_file = self._ReadDiffCache(cache_file)
+      if diff_file:
+        LOGGER.info("Using the cached diff %s", cache_file)
+        return self._ReadDiffLines(diff_file)
+
+    command = (cmd + ["-p", "--raw", "-z", "--no-abbrev"] + similarity_options +
+               extra_args)
+    diff_file = tempfile.TemporaryFile()
+    written = False
+    try:
+      written = self._WriteSingleDiff(command, env, diff_file)
+    finally:
+      if not written:
+        diff_file.close()
+    if not written:
+      return None
+    if cache_file:
+      self._WriteDiffCache(cache_dir, cache_file, diff_file)
+    return self._ReadDiffLines(diff_file)
+
+  def _WriteSingleDiff(self, command, env, diff_file):
+    """Runs the git diff command of _GenerateSingleDiffLines(), and writes the
+    diff it stands for to diff_file.
+
+    Returns:
+      False if the output of git diff can't be used, True otherwise.
+    """
+    lines = RunShellLines(command, universal_newlines=False, env=env)
+    # The raw entries are separated from the patches by an empty field.  They
+    # are small next to the patches, and all needed to sort them.
+    raw = []
+    for line in lines:
+      raw.append(line)
+      if "\0\0" in line:
+        break
+    if not raw:
+      ErrorExit("No output from %s" % command)
+    raw, _, first_line = "".join(raw).partition("\0\0")
+    fields = raw.split("\0")
+    entries = []
+    # The (status, filename) of each section of the patch.
+    sections = []
+    i = 0
+    while i + 1 < len(fields):
+      old_mode, _, old_hash, _, status = fields[i][1:].split()
+      # Renames and copies are followed by the source and the destination.
+      entries.append((status[0], fields[i + 1], old_mode, old_hash))
+      i += status[0] in "RC" and 3 or 2
+      # A type change is shown as a deletion followed by an addition.
+      sections.extend([entries[-1][:2]] * (status[0] == "T" and 2 or 1))
+
+    # Deletions come first, sorted by file name, so they are kept apart from
+    # the other sections until the whole patch has been read.
+    deletions = tempfile.TemporaryFile()
+    others = tempfile.TemporaryFile()
+    try:
+      # Map of filename -> (offset, length) of its deletion in deletions.
+      deleted = {}
+      section = 0
+      target = None
+      for line in itertools.chain([first_line], lines):
+        if line.startswith("diff --git "):
+          section += 1
+          target = None
+          if section <= len(sections):
+            status, filename = sections[section - 1]
+            target = others
+            if status == "D":
+              target = deletions
+              deleted[filename] = (deletions.tell(), 0)
+        if target:
+          # Match the universal newlines RunShell() reads the diff with.
+          line = line.replace("\r\n", "\n").replace("\r", "\n")
+          target.write(line)
+          if target is deletions:
+            offset, length = deleted[filename]
+            deleted[filename] = (offset, length + len(line))
+      if section != len(sections):
+        LOGGER.info("Unexpected output from %s", command)
+        return False
+
+      renamed = dict((filename, (old_mode, old_hash))
+                     for status, filename, old_mode, old_hash in entries
+                     if status == "R")
+      if renamed:
+        binary = self._GetBinaryForDiff(sorted(renamed))
+        if binary is None:
+          return False
+        for filename, (old_mode, old_hash) in renamed.iteritems():
+          deletion = self._FormatDeletion(
+              filename, old_mode, old_hash, binary[filename])
+          deletion = deletion.replace("\r\n", "\n").replace("\r", "\n")
+          deleted[filename] = (deletions.tell(), len(deletion))
+          deletions.write(deletion)
+
+      for filename in sorted(deleted):
+        offset, length = deleted[filename]
+        deletions.seek(offset)
+        while length > 0:
+          line = deletions.readline(min(length, 65536))
+          diff_file.write(line)
+          length -= len(line)
+      others.seek(0)
+      shutil.copyfileobj(others, diff_file)
+    finally:
+      deletions.close()
+      others.close()
+    return True
+
+  def _ReadDiffLines(self, diff_file):
+    """Yields the lines of diff_file from its start, and closes it."""
+    try:
+      diff_file.seek(0)
+      for line in diff_file:
+        yield line
+    finally:
+      diff_file.close()
+
+  def _GetDiffTrees(self, extra_args):
+    """Returns (base tree, head tree) if the diff arguments select the
+    difference between two commits, None otherwise."""
+    symmetric = len(extra_args) == 1 and "..." in extra_args[0]
+    if symmetric:
+      base, head = extra_args[0].split("...", 1)
+    elif len(extra_args) == 1 and ".." in extra_args[0]:
+      base, head = extra_args[0].split("..", 1)
+    elif len(extra_args) == 2:
+      base, head = extra_args
+    else:
+      return None
+    base = base or "HEAD"
+    head = head or "HEAD"
+    if base.startswith("-") or head.startswith("-"):
+      return None
+    if symmetric:
+      base, retcode = RunShellWithReturnCode(["git", "merge-base", base, head])
+      if retcode:
+        return None
+      base = base.strip()
+    trees, retcode = RunShellWithReturnCode(
+        ["git", "rev-parse", base + "^{tree}", head + "^{tree}"])
+    if retcode:
+      return None
+    return tuple(trees.split())
+
+  def _ReadDiffCache(self, cache_file):
+    """Returns a temporary file with the diff cached in cache_file, or None."""
+    diff_file = tempfile.TemporaryFile()
+    try:
+      cached = open(cache_file, "rb")
+      try:
+        decompressor = zlib.decompressobj()
+        for chunk in iter(lambda: cached.read(65536), ""):
+          diff_file.write(decompressor.decompress(chunk))
+        diff_file.write(decompressor.flush())
+      finally:
+        cached.close()
+      os.utime(cache_file, None)
+    except (IOError, OSError, zlib.error):
+      diff_file.close()
+      return None
+    return diff_file
+
+  def _WriteDiffCache(self, cache_dir, cache_file, diff_file):
+    try:
+      if not os.path.isdir(cache_dir):
+        os.mkdir(cache_dir)
+      # Written under another name first, so that an interrupted write
+      # never leaves a truncated entry behind.
+      handle, temp_path = tempfile.mkstemp(dir=cache_dir)
+      try:
+        cached = os.fdopen(handle, "wb")
+        try:
+          compressor = zlib.compressobj()
+          diff_file.seek(0)
+          for chunk in iter(lambda: diff_file.read(65536), ""):
+            cached.write(compressor.compress(chunk))
+          cached.write(compressor.flush())
+        finally:
+          cached.close()
+        os.rename(temp_path, cache_file)
+      finally:
+        if os.path.exists(temp_path):
+          os.remove(temp_path)
+      entries = [os.path.join(cache_dir, name)
+                 for name in os.listdir(cache_dir)]
+      entries.sort(key=os.path.getmtime)
+      for entry in entries[:-GIT_DIFF_CACHE_MAX_ENTRIES]:
+        os.remove(entry)
+    except (IOError, OSError) as e:
+      LOGGER.info("Can't write %s: %s", cache_file, e)
+
+  def _GetBinaryForDiff(self, filenames):
+    """Returns a map of filename -> whether git diff shows it as binary,
+    based on its content and the "diff" attribute.
+
+    Returns None if a file name would need quoting in the diff, or if a
+    diff driver is set for a file, since git diff's output for them isn't
+    reproduced here.
+    """
+    for filename in filenames:
+      if re.search(r'[^\x20-\x7e]|["\\]', filename):
+        return None
+    output = RunShell(["git", "check-attr", "-z", "diff", "--"] + filenames,
+                      universal_newlines=False)
+    fields = output.split("\0")
+    attributes = dict(zip(fields[0::3], fields[2::3]))
+    binary = {}
+    for filename in filenames:
+      value = attributes.get(filename, "unspecified")
+      # "-diff" makes git show a file as binary and "diff" as text, whatever
+      # its content; otherwise git looks at the content.
+      if value == "unset":
+        binary[filename] = True
+      elif value == "set":
+        binary[filename] = False
+      elif value == "unspecified":
+        binary[filename] = None
+      else:
+        return None
+    return binary
+
+  def _FormatDeletion(self, filename, mode, file_hash, is_binary):
+    """Formats the diff section git would show for deleting a file."""
+    content = self.GetFileContent(file_hash)
+    lines = ["diff --git a/%s b/%s\n" % (filename, filename),
+             "deleted file mode %s\n" % mode,
+             "index %s..%s\n" % (file_hash, "0" * 40)]
+    if not content:
+      return "".join(lines)
+    if is_binary is None:
+      # Same heuristic as git's buffer_is_binary().
+      is_binary = "\0" in content[:8000]
+    if is_binary:
+      lines.append("Binary files a/%s and /dev/null differ\n" % filename)
+      return "".join(lines)
+    # git ends file names that contain spaces with a tab.
+    lines.append("--- a/%s%s\n" % (filename, " " in filename and "\t" or ""))
+    lines.append("+++ /dev/null\n")
+    content_lines = content.split("\n")
+    if content.endswith("\n"):
+      content_lines.pop()
+    if len(content_lines) == 1:
+      lines.append("@@ -1 +0,0 @@\n")
+    else:
+      lines.append("@@ -1,%d +0,0 @@\n" % len(content_lines))
+    lines.extend("-%s\n" % line for line in content_lines)
+    if not content.endswith("\n"):
+      lines.append("\\ No newline at end of file\n")
+    return "".join(lines)
 
   def GetUnknownFiles(self):
     status = RunShell(["git", "ls-files", "--exclude-standard", "--others"],
@@ -1646,12 +3079,29 @@ class GitVCS(VersionControlSystem):
 
   def GetFileContent(self, file_hash):
     """Returns the content of a file identified by its git hash."""
+    data = self.cat_file.Read(file_hash)
+    if data is not None:
+      return data
     data, retcode = RunShellWithReturnCode(["git", "show", file_hash],
                                             universal_newlines=False)
     if retcode:
       ErrorExit("Got error status from 'git show %s'" % file_hash)
     return data
 
+  def _GetUploadedObject(self, file_hash):
+    """Returns the cached (checksum, size, is_binary) of a blob if the issue
+    being updated already has it as a base file, None otherwise."""
+    if not self.upload_cache or not self.options.issue:
+      return None
+    cached = self.upload_cache.GetObject(file_hash)
+    if cached and self.upload_cache.HasUpload(self.options.server,
+                                              self.options.issue, cached[0]):
+      return cached
+    return None
+
+  def GetDeferredBaseContent(self, filename):
+    return self.GetFileContent(self.hashes[filename][0])
+
   def GetBaseFile(self, filename):
     hash_before, hash_after = self.hashes.get(filename, (None,None))
     base_content = None
@@ -1662,9 +3112,11 @@ class GitVCS(VersionControlSystem):
       status = "A +"  # Match svn attribute name for renames.
       if filename not in self.hashes:
         # If a rename doesn't change the content, we never get a hash.
-        base_content = RunShell(
-            ["git", "show", "HEAD:" + filename], silent_ok=True,
-            universal_newlines=False)
+        base_content = self.cat_file.Read("HEAD:" + filename)
+        if base_content is None:
+          base_content = RunShell(
+              ["git", "show", "HEAD:" + filename], silent_ok=True,
+              universal_newlines=False)
     elif not hash_before:
       status = "A"
       base_content = ""
@@ -1675,10 +3127,23 @@ class GitVCS(VersionControlSystem):
 
     # Grab the before/after content if we need it.
     # Grab the base content if we don't have it already.
+    is_binary = self.IsImage(filename)
     if base_content is None and hash_before:
-      base_content = self.GetFileContent(hash_before)
+      cached = self._GetUploadedObject(hash_before)
+      if cached:
+        # The server has this exact blob for the issue already, so it will
+        # answer "nobase" and we don't need to read the content.
+        checksum, size, is_base_binary = cached
+        self.base_checksums[filename] = checksum
+        self.deferred_base[filename] = size
+        is_binary = is_binary or is_base_binary
+      else:
+        base_content = self.GetFileContent(hash_before)
+        if self.upload_cache:
+          self.upload_cache.AddObject(
+              hash_before, self.GetBaseChecksum(filename, base_content),
+              len(base_content), self.IsBinaryData(base_content))
 
-    is_binary = self.IsImage(filename)
     if base_content:
       is_binary = is_binary or self.IsBinaryData(base_content)
 
@@ -1695,6 +3160,9 @@ class GitVCS(VersionControlSystem):
 class CVSVCS(VersionControlSystem):
   """Implementation of the VersionControlSystem interface for CVS."""
 
+  # GetBaseFile() temporarily renames the working file, one file at a time.
+  parallel_base_files = False
+
   def __init__(self, options):
     super(CVSVCS, self).__init__(options)
 
@@ -1780,12 +3248,43 @@ class MercurialVCS(VersionControlSystem):
         self.base_rev = parent.split(':')[1].strip()
       else:
         self.base_rev = '0'
+    # Prefetched by _PrefetchBaseFiles(); keys are paths relative to the
+    # current directory.
+    # Map of path -> (status, path of the base file).
+    self.status_table = {}
+    # Map of base file path -> raw content at the base revision.
+    self.base_contents = {}
 
   def GetGUID(self):
+    """Returns the node of revision 0, cached in .hg/codereview-guid.
+
+    The cache is keyed by the changelog's first index entry, which holds
+    revision 0, so it stays valid as long as that revision is the same and
+    hg doesn't need to be started.
+    """
+    hg_dir = os.path.join(self.repo_dir, ".hg")
+    cache_file = os.path.join(hg_dir, GUID_CACHE_FILE)
+    key = None
+    for changelog in ("store/00changelog.i", "00changelog.i"):
+      try:
+        changelog_file = open(os.path.join(hg_dir, changelog), "rb")
+      except IOError:
+        continue
+      try:
+        key = changelog_file.read(64).encode("hex")
+      finally:
+        changelog_file.close()
+      break
+    cached = self._ReadGUIDCache(cache_file)
+    if key and cached and cached[0] == key:
+      return cached[1]
     # See chapter "Uniquely identifying a repository"
     # http://hgbook.red-bean.com/read/customizing-the-output-of-mercurial.html
     info = RunShell("hg log -r0 --template {node}".split())
-    return info.strip()
+    guid = info.strip()
+    if key:
+      self._WriteGUIDCache(cache_file, key, guid)
+    return guid
 
   def _GetRelPath(self, filename):
     """Get relative path of a file according to the current directory,
@@ -1829,13 +3328,86 @@ class MercurialVCS(VersionControlSystem):
         unknown_files.append(fn)
     return unknown_files
 
-  def GetBaseFile(self, filename):
-    # "hg status" and "hg cat" both take a path relative to the current subdir,
-    # but "hg diff" has given us the path relative to the repo root.
-    base_content = ""
-    new_content = None
-    is_binary = False
-    oldrelpath = relpath = self._GetRelPath(filename)
+  def _GetBaseRev(self):
+    """Returns the revision to get base files from."""
+    if ":" in self.base_rev:
+      return self.base_rev.split(":", 1)[0]
+    return self.base_rev
+
+  def _WriteListFile(self, directory, relpaths):
+    """Writes relpaths to a file for a "listfile0:" pattern, and returns the
+    pattern."""
+    list_filename = os.path.join(directory, "files")
+    list_file = open(list_filename, "wb")
+    try:
+      list_file.write("\0".join(relpaths))
+    finally:
+      list_file.close()
+    return "listfile0:" + list_filename
+
+  def CollectBaseFiles(self, filenames):
+    self._PrefetchBaseFiles(filenames)
+    return super(MercurialVCS, self).CollectBaseFiles(filenames)
+
+  def _PrefetchBaseFiles(self, filenames):
+    """Gets the status of all files with one "hg status -C" call and their
+    base contents with one "hg cat" call, instead of starting hg several
+    times per file.
+
+    GetBaseFile() falls back to running hg for a single file when something
+    isn't in status_table or base_contents.
+    """
+    if not filenames:
+      return
+    relpaths = [self._GetRelPath(filename) for filename in filenames]
+    temp_dir = tempfile.mkdtemp(prefix="upload-hg-")
+    try:
+      pattern = self._WriteListFile(temp_dir, relpaths)
+      out, returncode = RunShellWithReturnCode(
+          ["hg", "status", "-C", "--rev", self.base_rev, pattern])
+      if returncode:
+        return
+      relpath = None
+      for line in out.splitlines():
+        if line.startswith("  ") and relpath in self.status_table:
+          # Moved/copied => considered as modified, use old filename to
+          # retrieve base contents
+          self.status_table[relpath] = ("M", line.strip())
+        elif len(line) > 2 and line[1] == " ":
+          relpath = line[2:]
+          self.status_table[relpath] = (line[0], relpath)
+
+      base_relpaths = [oldrelpath
+                       for status, oldrelpath in self.status_table.values()
+                       if status != "A"]
+      if not base_relpaths:
+        return
+      pattern = self._WriteListFile(temp_dir, base_relpaths)
+      # %p is the path relative to the repository root.
+      output_pattern = os.path.join(temp_dir, "base", "%p")
+      # Files missing in the base revision make hg fail, but the others are
+      # still written; those are fetched one by one later.
+      RunShellWithReturnCode(["hg", "cat", "-r", self._GetBaseRev(),
+                              "--output", output_pattern, pattern])
+      for oldrelpath in base_relpaths:
+        repo_path = os.path.relpath(os.path.abspath(oldrelpath),
+                                    self.repo_dir)
+        try:
+          base_file = open(os.path.join(temp_dir, "base", repo_path), "rb")
+        except IOError:
+          continue
+        try:
+          self.base_contents[oldrelpath] = base_file.read()
+        finally:
+          base_file.close()
+    finally:
+      shutil.rmtree(temp_dir, ignore_errors=True)
+
+  def _GetStatus(self, relpath):
+    """Returns (status, path of the base file) for a file."""
+    if relpath in self.status_table:
+      return self.status_table[relpath]
+    oldrelpath = relpath
     # "hg status -C" returns two lines for moved/copied files, one otherwise
     out = RunShell(["hg", "status", "-C", "--rev", self.base_rev, relpath])
     out = out.splitlines()
@@ -1849,22 +3421,31 @@ class MercurialVCS(VersionControlSystem):
       # retrieve base contents
       oldrelpath = out[1].strip()
       status = "M"
-    if ":" in self.base_rev:
-      base_rev = self.base_rev.split(":", 1)[0]
-    else:
-      base_rev = self.base_rev
+    return status, oldrelpath
+
+  def GetBaseFile(self, filename):
+    # "hg status" and "hg cat" both take a path relative to the current subdir,
+    # but "hg diff" has given us the path relative to the repo root.
+    base_content = ""
+    new_content = None
+    is_binary = False
+    relpath = self._GetRelPath(filename)
+    status, oldrelpath = self._GetStatus(relpath)
     if status != "A":
-      base_content = RunShell(["hg", "cat", "-r", base_rev, oldrelpath],
-        silent_ok=True)
+      # Always read the raw bytes; newlines are converted below for text
+      # files, so binary files don't need to be fetched a second time.
+      base_content = self.base_contents.get(oldrelpath)
+      if base_content is None:
+        base_content = RunShell(["hg", "cat", "-r", self._GetBaseRev(),
+                                 oldrelpath],
+                                silent_ok=True, universal_newlines=False)
       is_binary = self.IsBinaryData(base_content)
     if status != "R":
       new_content = open(relpath, "rb").read()
       is_binary = is_binary or self.IsBinaryData(new_content)
-    if is_binary and base_content:
-      # Fetch again without converting newlines
-      base_content = RunShell(["hg", "cat", "-r", base_rev, oldrelpath],
-        silent_ok=True, universal_newlines=False)
     if not is_binary:
+      # Same as reading the output of "hg cat" with universal newlines.
+      base_content = base_content.replace("\r\n", "\n").replace("\r", "\n")
       new_content = None
     return base_content, new_content, is_binary, status
 
@@ -1898,11 +3479,19 @@ class PerforceVCS(VersionControlSystem):
     self.p4_client = options.p4_client
     self.p4_user = options.p4_user
 
+    # Results of the bulk queries made by _PrefetchMetadata().
+    self.prefetched = False
+    # The marshalled output of "p4 describe" for the changelist.
+    self.description = None
+    # Map of depot path -> "p4 fstat -Or" record.
+    self.fstat_records = {}
+    # Map of (depot path, revision) -> raw content.
+    self.base_contents = {}
+
     ConfirmLogin()
 
     if not options.title:
-      description = self.RunPerforceCommand(["describe", self.p4_changelist],
-                                            marshal_output=True)
+      description = self._GetDescription()
       if description and "desc" in description:
         # Rietveld doesn't support multi-line descriptions
         raw_title = description["desc"].strip()
@@ -1914,8 +3503,7 @@ class PerforceVCS(VersionControlSystem):
     """For now we don't know how to get repository ID for Perforce"""
     return
 
-  def RunPerforceCommandWithReturnCode(self, extra_args, marshal_output=False,
-                                       universal_newlines=True):
+  def _GetPerforceArgs(self, extra_args, marshal_output):
     args = ["p4"]
     if marshal_output:
       # -G makes perforce format its output as marshalled python objects
@@ -1927,7 +3515,11 @@ class PerforceVCS(VersionControlSystem):
     if self.p4_user:
       args.extend(["-u", self.p4_user])
     args.extend(extra_args)
+    return args
 
+  def RunPerforceCommandWithReturnCode(self, extra_args, marshal_output=False,
+                                       universal_newlines=True):
+    args = self._GetPerforceArgs(extra_args, marshal_output)
     data, retcode = RunShellWithReturnCode(
         args, print_output=False, universal_newlines=universal_newlines)
     if marshal_output and data:
@@ -1944,9 +3536,101 @@ class PerforceVCS(VersionControlSystem):
       ErrorExit("Got error status from %s:\n%s" % (extra_args, data))
     return data
 
+  def RunPerforceCommandForRecords(self, command, filenames):
+    """Runs a marshalled p4 command for many files at once.
+
+    The file arguments are passed with "p4 -x", so there is no limit on their
+    number, and all the objects p4 outputs are read, where
+    RunPerforceCommand() only returns the first one.
+
+    Returns:
+      A list of dicts, the records output by p4.  Errors for single files are
+      records with "code" set to "error".
+    """
+    args_file = tempfile.NamedTemporaryFile(delete=False)
+    try:
+      args_file.write("".join(filename + "\n" for filename in filenames))
+      args_file.close()
+      args = self._GetPerforceArgs(["-x", args_file.name] + command, True)
+      LOGGER.info("Running %s", args)
+      p = subprocess.Popen(args, stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE, shell=use_shell)
+      records = []
+      try:
+        while True:
+          records.append(marshal.load(p.stdout))
+      except EOFError:
+        pass
+      errout = p.stderr.read()
+      p.stdout.close()
+      p.stderr.close()
+      if p.wait():
+        LOGGER.info("%s failed: %s", args, errout)
+      return records
+    finally:
+      os.remove(args_file.name)
+
+  def _GetDescription(self):
+    """Returns the marshalled "p4 describe" of the changelist, which is only
+    queried once."""
+    if self.description is None:
+      self.description = self.RunPerforceCommand(
+          ["describe", self.p4_changelist], marshal_output=True)
+    return self.description
+
+  def _PrefetchMetadata(self):
+    """Gets the fstat records of all files in the changelist, and the base
+    revision of those that have one, with one fstat and one print command.
+
+    The per-file methods use these results and only fall back to querying
+    p4 for a single file when something isn't there.
+    """
+    if self.prefetched:
+      return
+    self.prefetched = True
+    changed_files = self.GetChangedFiles()
+    if not changed_files:
+      return
+    for record in self.RunPerforceCommandForRecords(["fstat", "-Or"],
+                                                    sorted(changed_files)):
+      if record.get("code") == "stat" and "depotFile" in record:
+        self.fstat_records[record["depotFile"]] = record
+
+    revisions = set()
+    for filename, action in changed_files.iteritems():
+      status = self.PerforceActionToSvnStatus(action)
+      if status not in ("M", "D"):
+        continue
+      base_filename = self.GetBaseFilename(filename)
+      record = self.fstat_records.get(base_filename)
+      if not record:
+        continue
+      # GetBaseFile() reads the revision we have, GenerateDiff() the head
+      # revision of deleted files.
+      for key in ("haveRev", "headRev"):
+        if key in record:
+          revisions.add("%s#%s" % (base_filename, record[key]))
+    if not revisions:
+      return
+
+    # "p4 print" outputs a record describing each file, followed by records
+    # with its content.
+    key = None
+    content = []
+    for record in self.RunPerforceCommandForRecords(["print"],
+                                                    sorted(revisions)):
+      if "depotFile" in record and "rev" in record:
+        if key:
+          self.base_contents[key] = "".join(content)
+        key = (record["depotFile"], record["rev"])
+        content = []
+      elif key and "data" in record:
+        content.append(record["data"])
+    if key:
+      self.base_contents[key] = "".join(content)
+
   def GetFileProperties(self, property_key_prefix = "", command = "describe"):
-    description = self.RunPerforceCommand(["describe", self.p4_changelist],
-                                          marshal_output=True)
+    description = self._GetDescription()
 
     changed_files = {}
     file_index = 0
@@ -1986,6 +3670,19 @@ class PerforceVCS(VersionControlSystem):
     return not file_types[filename].endswith("text")
 
   def GetFileContent(self, filename, revision, is_binary):
+    record = self.fstat_records.get(filename)
+    if revision:
+      key = (filename, revision)
+    elif record and "headRev" in record:
+      key = (filename, record["headRev"])
+    else:
+      key = None
+    if key in self.base_contents:
+      content = self.base_contents[key]
+      if not is_binary:
+        # Same as reading the output of "p4 print" with universal newlines.
+        content = content.replace("\r\n", "\n").replace("\r", "\n")
+      return content
     file_arg = filename
     if revision:
       file_arg += "#" + revision
@@ -2004,8 +3701,10 @@ class PerforceVCS(VersionControlSystem):
     # after a file was branched (integrated), then edited.
     if self.GetAction(filename) in actionsWithDifferentBases:
       # -Or shows information about pending integrations/moves
-      fstat_result = self.RunPerforceCommand(["fstat", "-Or", filename],
-                                             marshal_output=True)
+      fstat_result = self.fstat_records.get(filename)
+      if fstat_result is None:
+        fstat_result = self.RunPerforceCommand(["fstat", "-Or", filename],
+                                               marshal_output=True)
 
       baseFileKey = "resolveFromFile0" # I think it's safe to use only file0
       if baseFileKey in fstat_result:
@@ -2016,12 +3715,18 @@ class PerforceVCS(VersionControlSystem):
   def GetBaseRevision(self, filename):
     base_filename = self.GetBaseFilename(filename)
 
-    have_result = self.RunPerforceCommand(["have", base_filename],
-                                          marshal_output=True)
+    have_result = self.fstat_records.get(base_filename)
+    if have_result is None:
+      have_result = self.RunPerforceCommand(["have", base_filename],
+                                            marshal_output=True)
     if "haveRev" in have_result:
       return have_result["haveRev"]
 
   def GetLocalFilename(self, filename):
+    record = self.fstat_records.get(filename)
+    if record and "clientFile" in record:
+      # fstat shows the local path of the file, like "p4 where" does.
+      return record["clientFile"]
     where = self.RunPerforceCommand(["where", filename], marshal_output=True)
     if "path" in where:
       return where["path"]
@@ -2080,8 +3785,10 @@ class PerforceVCS(VersionControlSystem):
       return diffData
 
     def GenerateAddDiff(diffData):
-      fstat = self.RunPerforceCommand(["fstat", diffData.filename],
-                                      marshal_output=True)
+      fstat = self.fstat_records.get(diffData.filename)
+      if fstat is None:
+        fstat = self.RunPerforceCommand(["fstat", diffData.filename],
+                                        marshal_output=True)
       if "headRev" in fstat:
         diffData.base_rev = fstat["headRev"] # Re-adding a deleted file
       else:
@@ -2114,6 +3821,7 @@ class PerforceVCS(VersionControlSystem):
       diffData.prefix = "-"
       return diffData
 
+    self._PrefetchMetadata()
     changed_files = self.GetChangedFiles()
 
     svndiff = []
@@ -2166,6 +3874,10 @@ class PerforceVCS(VersionControlSystem):
 
     return changed_files[filename]
 
+  def CollectBaseFiles(self, filenames):
+    self._PrefetchMetadata()
+    return super(PerforceVCS, self).CollectBaseFiles(filenames)
+
   def GetBaseFile(self, filename):
     base_filename = self.GetBaseFilename(filename)
     base_content = ""
@@ -2231,17 +3943,28 @@ def SplitPatch(data):
   return patches
 
 
-def UploadSeparatePatches(issue, rpc_server, patchset, data, options):
+def UploadSeparatePatches(issue, rpc_server, patchset, data, options,
+                          journal=None, segments=None):
   """Uploads a separate patch for each file in the diff output.
 
+  Patches already recorded in journal (an UploadJournal) are not uploaded
+  again, and newly uploaded ones are added to it.  If the diff's segments
+  are given (see VersionControlSystem.GetPatchSegments), they are used
+  instead of splitting the diff again.
+
   Returns a list of [patch_key, filename] for each file.
   """
   def UploadFile(filename, data):
+    if isinstance(data, tuple):
+      # A segment of the diff; only read it now, so that at most one patch
+      # per concurrent request is in memory.
+      start, end = data
+      data = diff[start:end]
     form_fields = [("filename", filename)]
     if not options.download_base:
       form_fields.append(("content_upload", "1"))
     files = [("data", "data.diff", data)]
-    ctype, body = EncodeMultipartFormData(form_fields, files)
+    ctype, body = EncodeMultipartFormDataStream(form_fields, files)
     url = "/%d/upload_patch/%d" % (int(issue), int(patchset))
 
     try:
@@ -2254,27 +3977,40 @@ def UploadSeparatePatches(issue, rpc_server, patchset, data, options):
     if not lines or lines[0] != "OK":
       StatusUpdate("  --> %s" % response_body)
       sys.exit(1)
+    if journal:
+      journal.AddPatches([[lines[1], filename]])
     return ("Uploaded patch for " + filename, [lines[1], filename])
 
-  threads = []
-  thread_pool = ThreadPool(options.num_upload_threads)
+  scheduler = UploadScheduler(rpc_server, options.num_upload_threads)
 
-  patches = SplitPatch(data)
+  diff = data
+  if segments is not None:
+    patches = [(filename, (start, end)) for filename, start, end in segments]
+  else:
+    patches = SplitPatch(data)
   rv = []
+  uploaded = {}
+  if journal:
+    uploaded = dict((filename, key) for key, filename in journal.patches)
   for patch in patches:
-    if len(patch[1]) > MAX_UPLOAD_SIZE:
-      print ("Not uploading the patch for " + patch[0] +
+    filename = patch[0]
+    data = patch[1]
+    if isinstance(data, tuple):
+      size = data[1] - data[0]
+    else:
+      size = len(data)
+    if size > MAX_UPLOAD_SIZE:
+      print ("Not uploading the patch for " + filename +
              " because the file is too large.")
       continue
 
-    filename = patch[0]
-    data = patch[1]
+    if filename in uploaded:
+      rv.append([uploaded[filename], filename])
+      continue
 
-    t = thread_pool.apply_async(UploadFile, args=(filename, data))
-    threads.append(t)
+    scheduler.Add(size, UploadFile, filename, data)
 
-  for t in threads:
-    result = t.get(timeout=60)
+  for result in scheduler.Run():
     print result[0]
     rv.append(result[1])
 
@@ -2545,164 +4281,203 @@ def RealMain(argv, data=None):
     LOGGER.setLevel(logging.INFO)
 
   vcs = GuessVCS(options)
-
-  base = options.base_url
-  if isinstance(vcs, SubversionVCS):
-    # Guessing the base field is only supported for Subversion.
-    # Note: Fetching base files may become deprecated in future releases.
-    guessed_base = vcs.GuessBase(options.download_base)
-    if base:
-      if guessed_base and base != guessed_base:
-        print "Using base URL \"%s\" from --base_url instead of \"%s\"" % \
-            (base, guessed_base)
+  rpc_server = None
+  try:
+    base = options.base_url
+    if isinstance(vcs, SubversionVCS):
+      # Guessing the base field is only supported for Subversion.
+      # Note: Fetching base files may become deprecated in future releases.
+      guessed_base = vcs.GuessBase(options.download_base)
+      if base:
+        if guessed_base and base != guessed_base:
+          print "Using base URL \"%s\" from --base_url instead of \"%s\"" % \
+              (base, guessed_base)
+      else:
+        base = guessed_base
+
+    if not base and options.download_base:
+      options.download_base = True
+      LOGGER.info("Enabled upload of base file")
+    if options.use_upload_cache:
+      vcs.upload_cache = UploadCache(UPLOAD_CACHE_FILE)
+    if not options.assume_yes:
+      vcs.CheckForUnknownFiles()
+    if data is None:
+      data = vcs.GenerateProcessedDiff(args)
     else:
-      base = guessed_base
-
-  if not base and options.download_base:
-    options.download_base = True
-    LOGGER.info("Enabled upload of base file")
-  if not options.assume_yes:
-    vcs.CheckForUnknownFiles()
-  if data is None:
-    data = vcs.GenerateDiff(args)
-  data = vcs.PostProcessDiff(data)
-  if options.print_diffs:
-    print "Rietveld diff start:*****"
-    print data
-    print "Rietveld diff end:*****"
-  files = vcs.GetBaseFiles(data)
-  if verbosity >= 1:
-    print "Upload server:", options.server, "(change with -s/--server)"
-  if options.use_oauth2:
-    options.save_cookies = False
-  rpc_server = GetRpcServer(options.server,
-                            options.email,
-                            options.host,
-                            options.save_cookies,
-                            options.account_type,
-                            options.use_oauth2,
-                            options.oauth2_port,
-                            options.open_oauth2_local_webbrowser)
-  form_fields = []
-
-  repo_guid = vcs.GetGUID()
-  if repo_guid:
-    form_fields.append(("repo_guid", repo_guid))
-  if base:
-    b = urlparse.urlparse(base)
-    username, netloc = urllib.splituser(b.netloc)
-    if username:
-      LOGGER.info("Removed username from base URL")
-      base = urlparse.urlunparse((b.scheme, netloc, b.path, b.params,
-                                  b.query, b.fragment))
-    form_fields.append(("base", base))
-  if options.issue:
-    form_fields.append(("issue", str(options.issue)))
-  if options.email:
-    form_fields.append(("user", options.email))
-  if options.reviewers:
-    for reviewer in options.reviewers.split(','):
-      CheckReviewer(reviewer)
-    form_fields.append(("reviewers", options.reviewers))
-  if options.cc:
-    for cc in options.cc.split(','):
-      CheckReviewer(cc)
-    form_fields.append(("cc", options.cc))
-
-  # Process --message, --title and --file.
-  message = options.message or ""
-  title = options.title or ""
-  if options.file:
-    if options.message:
-      ErrorExit("Can't specify both message and message file options")
-    file = open(options.file, 'r')
-    message = file.read()
-    file.close()
-  if options.issue:
-    prompt = "Title describing this patch set: "
-  else:
-    prompt = "New issue subject: "
-  title = (
-      title or message.split('\n', 1)[0].strip() or raw_input(prompt).strip())
-  if not title and not options.issue:
-    ErrorExit("A non-empty title is required for a new issue")
-  # For existing issues, it's fine to give a patchset an empty name. Rietveld
-  # doesn't accept that so use a whitespace.
-  title = title or " "
-  if len(title) > 100:
-    title = title[:99] + '…'
-  if title and not options.issue:
-    message = message or title
-
-  form_fields.append(("subject", title))
-  # If it's a new issue send message as description. Otherwise a new
-  # message is created below on upload_complete.
-  if message and not options.issue:
-    form_fields.append(("description", message))
-
-  # Send a hash of all the base file so the server can determine if a copy
-  # already exists in an earlier patchset.
-  base_hashes = ""
-  for file, info in files.iteritems():
-    if not info[0] is None:
-      checksum = md5(info[0]).hexdigest()
-      if base_hashes:
-        base_hashes += "|"
-      base_hashes += checksum + ":" + file
-  form_fields.append(("base_hashes", base_hashes))
-  if options.private:
+      data = vcs.PostProcessDiff(data)
+    if options.print_diffs:
+      print "Rietveld diff start:*****"
+      # data[:] also works for an mmap of the diff, see --git_spill_diff.
+      print data[:]
+      print "Rietveld diff end:*****"
+    files = vcs.GetBaseFiles(data)
+    if verbosity >= 1:
+      print "Upload server:", options.server, "(change with -s/--server)"
+    if options.use_oauth2:
+      options.save_cookies = False
+    rpc_server = GetRpcServer(options.server,
+                              options.email,
+                              options.host,
+                              options.save_cookies,
+                              options.account_type,
+                              options.use_oauth2,
+                              options.oauth2_port,
+                              options.open_oauth2_local_webbrowser,
+                              (options.connection_pool_size or
+                               options.num_upload_threads))
+    form_fields = []
+
+    repo_guid = vcs.GetGUID()
+    if repo_guid:
+      form_fields.append(("repo_guid", repo_guid))
+    if base:
+      b = urlparse.urlparse(base)
+      username, netloc = urllib.splituser(b.netloc)
+      if username:
+        LOGGER.info("Removed username from base URL")
+        base = urlparse.urlunparse((b.scheme, netloc, b.path, b.params,
+                                    b.query, b.fragment))
+      form_fields.append(("base", base))
     if options.issue:
-      print "Warning: Private flag ignored when updating an existing issue."
-    else:
-      form_fields.append(("private", "1"))
-  if options.send_patch:
-    options.send_mail = True
-  if not options.download_base:
-    form_fields.append(("content_upload", "1"))
-  if len(data) > MAX_UPLOAD_SIZE:
-    print "Patch is large, so uploading file patches separately."
-    uploaded_diff_file = []
-    form_fields.append(("separate_patches", "1"))
-  else:
-    uploaded_diff_file = [("data", "data.diff", data)]
-  ctype, body = EncodeMultipartFormData(form_fields, uploaded_diff_file)
-  response_body = rpc_server.Send("/upload", body, content_type=ctype)
-  patchset = None
-  if not options.download_base or not uploaded_diff_file:
-    lines = response_body.splitlines()
-    if len(lines) >= 2:
-      msg = lines[0]
-      patchset = lines[1].strip()
-      patches = [x.split(" ", 1) for x in lines[2:]]
+      form_fields.append(("issue", str(options.issue)))
+    if options.email:
+      form_fields.append(("user", options.email))
+    if options.reviewers:
+      for reviewer in options.reviewers.split(','):
+        CheckReviewer(reviewer)
+      form_fields.append(("reviewers", options.reviewers))
+    if options.cc:
+      for cc in options.cc.split(','):
+        CheckReviewer(cc)
+      form_fields.append(("cc", options.cc))
+
+    # Process --message, --title and --file.
+    message = options.message or ""
+    title = options.title or ""
+    if options.file:
+      if options.message:
+        ErrorExit("Can't specify both message and message file options")
+      file = open(options.file, 'r')
+      message = file.read()
+      file.close()
+    if options.issue:
+      prompt = "Title describing this patch set: "
     else:
-      msg = response_body
-  else:
-    msg = response_body
-  StatusUpdate(msg)
-  if not response_body.startswith("Issue created.") and \
-  not response_body.startswith("Issue updated."):
-    sys.exit(0)
-  issue = msg[msg.rfind("/")+1:]
-
-  if not uploaded_diff_file:
-    result = UploadSeparatePatches(issue, rpc_server, patchset, data, options)
+      prompt = "New issue subject: "
+    title = (
+        title or message.split('\n', 1)[0].strip() or raw_input(prompt).strip())
+    if not title and not options.issue:
+      ErrorExit("A non-empty title is required for a new issue")
+    # For existing issues, it's fine to give a patchset an empty name. Rietveld
+    # doesn't accept that so use a whitespace.
+    title = title or " "
+    if len(title) > 100:
+      title = title[:99] + '…'
+    if title and not options.issue:
+      message = message or title
+
+    form_fields.append(("subject", title))
+    # If it's a new issue send message as description. Otherwise a new
+    # message is created below on upload_complete.
+    if message and not options.issue:
+      form_fields.append(("description", message))
+
+    # Send a hash of all the base file so the server can determine if a copy
+    # already exists in an earlier patchset.
+    base_hashes = ""
+    for file, info in files.iteritems():
+      if not info[0] is None or file in vcs.deferred_base:
+        checksum = vcs.GetBaseChecksum(file, info[0])
+        if base_hashes:
+          base_hashes += "|"
+        base_hashes += checksum + ":" + file
+    form_fields.append(("base_hashes", base_hashes))
+    if options.private:
+      if options.issue:
+        print "Warning: Private flag ignored when updating an existing issue."
+      else:
+        form_fields.append(("private", "1"))
+    if options.send_patch:
+      options.send_mail = True
     if not options.download_base:
-      patches = result
+      form_fields.append(("content_upload", "1"))
+    if len(data) > MAX_UPLOAD_SIZE:
+      print "Patch is large, so uploading file patches separately."
+      uploaded_diff_file = []
+      form_fields.append(("separate_patches", "1"))
+    else:
+      uploaded_diff_file = [("data", "data.diff", data)]
+    journal = None
+    if options.journal and not options.download_base:
+      journal = UploadJournal(options.journal)
+      diff_checksum = md5(data).hexdigest()
+      if options.resume:
+        journal.Load()
+        if not journal.Matches(options.server, options.issue, diff_checksum):
+          StatusUpdate("No interrupted upload of this diff to resume.")
+          journal = UploadJournal(options.journal)
+    if journal and journal.issue:
+      issue, patchset = journal.issue, journal.patchset
+      patches = journal.patches
+      StatusUpdate("Resuming upload of patch set %s of issue %s." %
+                   (patchset, issue))
+    else:
+      ctype, body = EncodeMultipartFormDataStream(form_fields,
+                                                  uploaded_diff_file)
+      response_body = rpc_server.Send("/upload", body, content_type=ctype)
+      patchset = None
+      if not options.download_base or not uploaded_diff_file:
+        lines = response_body.splitlines()
+        if len(lines) >= 2:
+          msg = lines[0]
+          patchset = lines[1].strip()
+          patches = [x.split(" ", 1) for x in lines[2:]]
+        else:
+          msg = response_body
+      else:
+        msg = response_body
+      StatusUpdate(msg)
+      if not response_body.startswith("Issue created.") and \
+      not response_body.startswith("Issue updated."):
+        sys.exit(0)
+      issue = msg[msg.rfind("/")+1:]
+      if journal and patchset:
+        journal.Start(options.server, issue, patchset, diff_checksum)
+        if uploaded_diff_file:
+          journal.AddPatches(patches)
+      else:
+        journal = None
+    vcs.journal = journal
 
-  if not options.download_base:
-    vcs.UploadBaseFiles(issue, rpc_server, patches, patchset, options, files)
+    if not uploaded_diff_file:
+      result = UploadSeparatePatches(issue, rpc_server, patchset, data, options,
+                                     journal, vcs.GetPatchSegments(data))
+      if not options.download_base:
+        patches = result
 
-  payload = {}  # payload for final request
-  if options.send_mail:
-    payload["send_mail"] = "yes"
-    if options.send_patch:
-      payload["attach_patch"] = "yes"
-  if options.issue and message:
-    payload["message"] = message
-  payload = urllib.urlencode(payload)
-  rpc_server.Send("/" + issue + "/upload_complete/" + (patchset or ""),
-                  payload=payload)
-  return issue, patchset
+    if not options.download_base:
+      vcs.UploadBaseFiles(issue, rpc_server, patches, patchset, options, files)
+
+    payload = {}  # payload for final request
+    if options.send_mail:
+      payload["send_mail"] = "yes"
+      if options.send_patch:
+        payload["attach_patch"] = "yes"
+    if options.issue and message:
+      payload["message"] = message
+    payload = urllib.urlencode(payload)
+    rpc_server.Send("/" + issue + "/upload_complete/" + (patchset or ""),
+                    payload=payload)
+    if journal:
+      journal.Remove()
+    return issue, patchset
+  finally:
+    vcs.Close()
+    # git cl calls this in-process, so don't leave the keep-alive
+    # connections open after the upload.
+    if rpc_server:
+      rpc_server.connection_pool.CloseAll()
 
 
 def main():